@@ -1,27 +1,220 @@
 import queue
+import random
 import threading
 import time
-import json
 import asyncio
-from typing import List, Optional, Dict
+from array import array
+from collections import deque
+from contextlib import suppress
+from enum import Enum
+from functools import lru_cache
+from typing import Awaitable, Callable, Deque, Dict, List, Optional, Tuple
 
-from aiohttp import ClientSession
+import orjson
+from aiohttp import ClientSession, ClientTimeout, TCPConnector
 
 from copilot_more.logger import logger
 from copilot_more.settings import settings
 
-# Dictionary to store cached tokens {token_index: {"token": str, "expires_at": int}}
-CACHED_TOKENS: Dict[int, dict] = {}
-
-# Dictionary to store token errors
+# Dictionary to store token errors. Only single-key set/pop and copy() are used
+# on it, which are atomic under the GIL, so it needs no lock
 TOKEN_ERRORS: Dict[int, str] = {}
 
-TOKEN_LOCK = threading.Lock()
+# Guards reads of CACHED_TOKENS from coroutines; never held across an await
+TOKEN_LOCK = asyncio.Lock()
+# Guards the synchronous cache mutation in cache_copilot_token
+CACHE_WRITE_LOCK = threading.Lock()
+# Pending refreshes {token_index: Task resolving to the refreshed token data}
+INFLIGHT: Dict[int, asyncio.Task] = {}
+
 TOKEN_CACHE_QUEUE: queue.Queue = queue.Queue(maxsize=1)
 
-def get_all_tokens() -> List[str]:
+# Shared session for token refresh requests, created lazily by _get_session
+_SESSION: Optional[ClientSession] = None
+
+# Treat tokens as expired this many seconds early, +/- a random jitter so that
+# processes started together don't all refresh at the same moment
+TOKEN_EXPIRY_MARGIN_SECONDS = 300
+TOKEN_EXPIRY_JITTER_SECONDS = 30
+_rng = random.SystemRandom()
+
+# Retry policy for transient failures while switching tokens
+BACKOFF_INITIAL_SECONDS = 0.5
+BACKOFF_MAX_SECONDS = 30.0
+MAX_ATTEMPTS_PER_TOKEN = 3
+
+# Background task that refreshes cached tokens before they expire
+REFRESHER_TASK: Optional[asyncio.Task] = None
+# Upper bound on how long the refresher sleeps between scans
+REFRESHER_MAX_SLEEP_SECONDS = 60
+# Delay before retrying a token whose background refresh failed
+REFRESHER_RETRY_SECONDS = 30
+
+class TokenRefreshError(ValueError):
+    """Raised when refreshing a Copilot token fails."""
+
+    def __init__(
+        self, message: str, status: Optional[int] = None, retryable: bool = False
+    ):
+        super().__init__(message)
+        self.status = status
+        self.retryable = retryable
+
+
+class BreakerState(Enum):
+    CLOSED = "closed"  # Requests flow normally
+    OPEN = "open"  # Requests fail fast without calling GitHub
+    HALF_OPEN = "half_open"  # A single probe request is allowed through
+
+
+class TokenRefreshBreaker:
+    """Circuit breaker that fails token refreshes fast while GitHub is failing."""
+
+    def __init__(
+        self,
+        failure_threshold: int = 5,
+        window_seconds: float = 60.0,
+        cooldown_seconds: float = 30.0,
+    ):
+        self.failure_threshold = failure_threshold
+        self.window_seconds = window_seconds
+        self.cooldown_seconds = cooldown_seconds
+        self.state = BreakerState.CLOSED
+        self.failure_times: Deque[float] = deque()
+        self.opened_at = 0.0
+        self.probe_in_flight = False
+        self.probe_started_at = 0.0
+
+    def allow_request(self) -> bool:
+        """Return whether a refresh request may be sent now."""
+        if self.state == BreakerState.OPEN:
+            if time.monotonic() - self.opened_at < self.cooldown_seconds:
+                return False
+            logger.info("Token refresh circuit half-open, allowing a probe request")
+            self.state = BreakerState.HALF_OPEN
+            self.probe_in_flight = False
+
+        if self.state == BreakerState.HALF_OPEN:
+            # A probe that never reported back (e.g. cancelled) is replaced
+            # after another cooldown period
+            now = time.monotonic()
+            if self.probe_in_flight and now - self.probe_started_at < self.cooldown_seconds:
+                return False
+            self.probe_in_flight = True
+            self.probe_started_at = now
+
+        return True
+
+    def on_success(self) -> None:
+        """Record a successful round-trip to the token endpoint."""
+        if self.state != BreakerState.CLOSED:
+            logger.info("Token refresh circuit closed")
+        self.state = BreakerState.CLOSED
+        self.failure_times.clear()
+        self.probe_in_flight = False
+
+    def on_failure(self) -> None:
+        """Record a failed round-trip, opening the circuit past the threshold."""
+        now = time.monotonic()
+        self.failure_times.append(now)
+        while self.failure_times and self.failure_times[0] < now - self.window_seconds:
+            self.failure_times.popleft()
+
+        if (
+            self.state == BreakerState.HALF_OPEN
+            or len(self.failure_times) >= self.failure_threshold
+        ):
+            logger.warning(
+                f"Token refresh circuit open for {self.cooldown_seconds}s after "
+                f"{len(self.failure_times)} failures"
+            )
+            self.state = BreakerState.OPEN
+            self.opened_at = now
+            self.probe_in_flight = False
+
+
+REFRESH_BREAKER = TokenRefreshBreaker()
+
+
+class TokenStore:
+    """
+    Cached tokens by index, stored as parallel arrays.
+
+    Expiry and refresh times live in contiguous float arrays, so finding the
+    next token to refresh is a single C-level min() rather than a walk over
+    one dict per token.
+    """
+
+    def __init__(self):
+        self.tokens: List[Optional[dict]] = []
+        self.expires_at = array("d")
+        # When the background refresher should next refresh each token
+        self.refresh_at = array("d")
+
+    def _ensure_index(self, index: int) -> None:
+        """Grow the arrays so that index is a valid slot."""
+        while len(self.tokens) <= index:
+            self.tokens.append(None)
+            self.expires_at.append(0.0)
+            self.refresh_at.append(float("inf"))
+
+    def get(self, index: int) -> Optional[dict]:
+        """Get the cached token data at an index, if any."""
+        if 0 <= index < len(self.tokens):
+            return self.tokens[index]
+        return None
+
+    def set(self, index: int, token_data: dict, issued_at: float) -> None:
+        """Cache token data, scheduling its refresh at half of its lifetime."""
+        self._ensure_index(index)
+        expires_at = token_data.get("expires_at", 0)
+        self.tokens[index] = token_data
+        self.expires_at[index] = expires_at
+        if not expires_at:
+            # Without an expiry there is nothing to refresh ahead of
+            self.refresh_at[index] = float("inf")
+            return
+        # Never sooner than the retry delay, so a short-lived or already expired
+        # token can't make the refresher loop without sleeping
+        self.refresh_at[index] = max(
+            expires_at - (expires_at - issued_at) // 2,
+            issued_at + REFRESHER_RETRY_SECONDS,
+        )
+
+    def defer(self, index: int, until: float) -> None:
+        """Postpone the next refresh of a cached token."""
+        self.refresh_at[index] = until
+
+    def next_refresh(self) -> Tuple[Optional[int], float]:
+        """Return (index, refresh time) of the token due soonest, or (None, inf)."""
+        if not self.refresh_at:
+            return None, float("inf")
+        refresh_at = min(self.refresh_at)
+        if refresh_at == float("inf"):
+            return None, refresh_at
+        return self.refresh_at.index(refresh_at), refresh_at
+
+
+# Cached tokens {token_index: {"token": str, "expires_at": int}}
+CACHED_TOKENS = TokenStore()
+
+@lru_cache(maxsize=1)
+def _split_tokens(raw: str) -> Tuple[str, ...]:
+    """Split a comma-separated token string; cached on the raw string."""
+    return tuple(token.strip() for token in raw.split(","))
+
+def get_all_tokens() -> Tuple[str, ...]:
     """Get all available refresh tokens."""
-    return [token.strip() for token in settings.refresh_token.split(",")]
+    # Keyed on the raw setting, so a changed REFRESH_TOKEN is picked up automatically
+    return _split_tokens(settings.refresh_token)
+
+@lru_cache(maxsize=1)
+def _auth_headers(raw: str, editor_version: str) -> Tuple[dict, ...]:
+    """Build the refresh request headers for each token; cached on the settings they use."""
+    return tuple(
+        {"Authorization": f"token {token}", "editor-version": editor_version}
+        for token in _split_tokens(raw)
+    )
 
 def get_current_token_index() -> int:
     """Get the index of the currently active token."""
@@ -38,136 +231,282 @@ def set_current_token_index(index: int) -> None:
 def cache_copilot_token(token_data: dict, index: int) -> None:
     """Cache a token for a specific index."""
     logger.info(f"Caching token for index {index}")
-    global CACHED_TOKENS
-    with TOKEN_LOCK:
-        logger.debug(
-            f"Caching new token at index {index} that expires at {token_data.get('expires_at')}"
-        )
-        CACHED_TOKENS[index] = token_data
+    # Lazy arguments are only evaluated if DEBUG logging is enabled
+    logger.opt(lazy=True).debug(
+        "Caching new token at index {} that expires at {}",
+        lambda: index,
+        lambda: token_data.get("expires_at"),
+    )
+    # Log outside the lock to keep the critical section to the cache update
+    with CACHE_WRITE_LOCK:
+        CACHED_TOKENS.set(index, token_data, time.time())
         # Clear any error state for this token since it's now working
-        if index in TOKEN_ERRORS:
-            del TOKEN_ERRORS[index]
-        logger.debug("Token cached successfully")
+        TOKEN_ERRORS.pop(index, None)
+    logger.debug("Token cached successfully")
 
 def record_token_error(index: int, error_msg: str) -> None:
     """Record an error for a specific token."""
-    global TOKEN_ERRORS
     TOKEN_ERRORS[index] = error_msg
     logger.error(f"Token {index} error: {error_msg}")
 
 def get_token_errors() -> Dict[int, str]:
-    """Get all recorded token errors."""
-    return TOKEN_ERRORS
+    """Get a snapshot of all recorded token errors."""
+    return TOKEN_ERRORS.copy()
 
 async def get_cached_copilot_token() -> dict:
     """Get the currently active cached token, refreshing if necessary."""
     current_index = get_current_token_index()
-    with TOKEN_LOCK:
+    # Snapshot the cache entry under the lock and release it before any await,
+    # so a refresh that re-enters this function cannot deadlock on TOKEN_LOCK
+    async with TOKEN_LOCK:
+        cached_token = CACHED_TOKENS.get(current_index)
         current_time = time.time()
-        if current_index in CACHED_TOKENS:
-            cached_token = CACHED_TOKENS[current_index]
-            expires_at = cached_token.get("expires_at", 0)
-            logger.info(
-                f"Current token (index {current_index}) expires at {expires_at}, current time is {current_time}"
+        expiry_margin = TOKEN_EXPIRY_MARGIN_SECONDS + _rng.uniform(
+            -TOKEN_EXPIRY_JITTER_SECONDS, TOKEN_EXPIRY_JITTER_SECONDS
+        )
+        is_fresh = (
+            cached_token is not None
+            and cached_token.get("expires_at", 0) > current_time + expiry_margin
+        )
+        # Only one refresh of a given index runs at a time; callers share its task
+        refresh = None
+        is_leader = False
+        if not is_fresh:
+            is_leader = current_index not in INFLIGHT
+            refresh = _start_refresh(
+                current_index, lambda: _refresh_and_cache(current_index)
             )
 
-            if expires_at > time.time() + 300:
-                logger.info(f"Using cached token at index {current_index}")
-                return cached_token
+    if cached_token is not None:
+        logger.info(
+            f"Current token (index {current_index}) expires at {cached_token.get('expires_at', 0)}, current time is {current_time}"
+        )
 
-    logger.info(f"Token at index {current_index} expired or not found, refreshing...")
-    try:
-        new_token = await refresh_token(current_index)
+    if is_fresh:
+        logger.info(f"Using cached token at index {current_index}")
+        return cached_token
+
+    assert refresh is not None
+    if is_leader:
         logger.info(
-            f"Token at index {current_index} refreshed successfully, expires at {new_token.get('expires_at')}"
+            f"Token at index {current_index} expired or not found, refreshing..."
         )
-        cache_copilot_token(new_token, current_index)
-        return new_token
-    except ValueError as e:
-        # If current token fails, try next available token
-        await try_next_valid_token()
-        return await get_cached_copilot_token()
+    else:
+        logger.info(f"Waiting for in-flight refresh of token at index {current_index}")
+    # Shielded, so a cancelled caller (e.g. a disconnected client) doesn't
+    # cancel the refresh the other callers are waiting on
+    return await asyncio.shield(refresh)
+
+def _start_refresh(index: int, refresh: Callable[[], Awaitable[dict]]) -> asyncio.Task:
+    """Return the running refresh of a token index, or start one with refresh()."""
+    task = INFLIGHT.get(index)
+    if task is None:
+        task = asyncio.create_task(refresh())
+        INFLIGHT[index] = task
+        task.add_done_callback(lambda done: _finish_refresh(index, done))
+    return task
+
+def _finish_refresh(index: int, task: asyncio.Task) -> None:
+    """Forget a finished refresh, so the next caller starts a new one."""
+    if INFLIGHT.get(index) is task:
+        del INFLIGHT[index]
+    # Mark the exception as retrieved so a refresh without waiters doesn't log it
+    if not task.cancelled():
+        task.exception()
+
+async def _refresh_and_cache(current_index: int) -> dict:
+    """Refresh and cache the token at an index, falling back to the next valid token."""
+    index, new_token = await _find_working_token(current_index)
+    logger.info(
+        f"Token at index {index} refreshed successfully, expires at {new_token.get('expires_at')}"
+    )
+    cache_copilot_token(new_token, index)
+    return new_token
+
+
+def _backoff_delay(attempt: int) -> float:
+    """Exponential backoff delay with jitter for the given 0-based attempt."""
+    return min(
+        BACKOFF_MAX_SECONDS, BACKOFF_INITIAL_SECONDS * (2**attempt)
+    ) + _rng.uniform(0, BACKOFF_INITIAL_SECONDS)
+
+
+async def _find_working_token(start_index: int) -> Tuple[int, dict]:
+    """
+    Refresh tokens from start_index onwards until one succeeds, switching the
+    active token to it. Returns (index, token_data).
+    """
+    tokens = get_all_tokens()
+
+    # Each token gets a bounded number of attempts, so a full failover costs
+    # at most MAX_ATTEMPTS_PER_TOKEN requests per token
+    for i in range(start_index, len(tokens)):
+        for attempt in range(MAX_ATTEMPTS_PER_TOKEN):
+            try:
+                token_data = await _refresh_one(i)
+            except ValueError as e:
+                logger.error(f"Token {i} failed: {str(e)}")
+                # Rejected tokens won't recover by retrying, move on immediately
+                retryable = isinstance(e, TokenRefreshError) and e.retryable
+                if not retryable or attempt == MAX_ATTEMPTS_PER_TOKEN - 1:
+                    break
+                await asyncio.sleep(_backoff_delay(attempt))
+            else:
+                if i != get_current_token_index():
+                    set_current_token_index(i)
+                    logger.info(f"Successfully switched to token {i}")
+                return i, token_data
+
+    # If we get here, all remaining tokens failed
+    raise ValueError("All available tokens have failed")
+
 
 async def try_next_valid_token() -> None:
     """Try to switch to the next valid token."""
-    current_index = get_current_token_index()
-    tokens = get_all_tokens()
-    
-    # Try each subsequent token
-    for i in range(current_index + 1, len(tokens)):
+    await _find_working_token(get_current_token_index() + 1)
+
+async def _refresher_loop() -> None:
+    """Refresh each cached token once half of its lifetime has elapsed."""
+    while True:
+        index, refresh_at = CACHED_TOKENS.next_refresh()
+        now = time.time()
+        if index is None or refresh_at > now:
+            sleep_for = max(1.0, min(refresh_at - now, REFRESHER_MAX_SLEEP_SECONDS))
+            await asyncio.sleep(sleep_for + _rng.uniform(0, 0.1) * sleep_for)
+            continue
+
+        logger.info(f"Proactively refreshing token at index {index}")
         try:
-            # Add delay before trying next token
-            await asyncio.sleep(2)
-            logger.info(f"Attempting to switch to token {i}...")
-            
-            # Try to refresh the token first to validate it
-            await refresh_token(i)
-            # If successful, switch to this token
-            set_current_token_index(i)
-            logger.info(f"Successfully switched to token {i}")
-            return
+            # Joins a refresh of this index that a request already started
+            await asyncio.shield(_start_refresh(index, lambda: _refresh_index(index)))
         except ValueError as e:
-            logger.error(f"Token {i} also failed: {str(e)}")
-            await asyncio.sleep(1)  # Add small delay between failures
-            continue
-    
-    # If we get here, all remaining tokens failed
-    raise ValueError("All available tokens have failed")
+            logger.warning(f"Background refresh of token {index} failed: {str(e)}")
+        # A refresh that cached this token rescheduled it; if it failed, or a
+        # request's refresh moved on to another token, try again later
+        if CACHED_TOKENS.refresh_at[index] <= time.time():
+            CACHED_TOKENS.defer(index, time.time() + REFRESHER_RETRY_SECONDS)
+
+async def _refresh_index(index: int) -> dict:
+    """Refresh and cache the token at an index, without switching tokens."""
+    token_data = await _refresh_one(index)
+    cache_copilot_token(token_data, index)
+    return token_data
+
+def start_token_refresher() -> None:
+    """Start the background token refresher if it is not already running."""
+    global REFRESHER_TASK
+    if REFRESHER_TASK is None or REFRESHER_TASK.done():
+        REFRESHER_TASK = asyncio.create_task(_refresher_loop())
+        logger.info("Started background token refresher")
+
+async def stop_token_refresher() -> None:
+    """Cancel the background token refresher and wait for it to exit."""
+    global REFRESHER_TASK
+    if REFRESHER_TASK is None:
+        return
+    REFRESHER_TASK.cancel()
+    with suppress(asyncio.CancelledError):
+        await REFRESHER_TASK
+    REFRESHER_TASK = None
+
+async def _get_session() -> ClientSession:
+    """Get the shared token refresh session, creating it on first use."""
+    global _SESSION
+    if _SESSION is None or _SESSION.closed:
+        _SESSION = ClientSession(
+            connector=TCPConnector(limit=10, keepalive_timeout=300),
+            timeout=ClientTimeout(total=15),
+        )
+    return _SESSION
+
+async def close_session() -> None:
+    """Close the shared token refresh session."""
+    global _SESSION
+    if _SESSION is not None:
+        await _SESSION.close()
+        _SESSION = None
 
 def parse_github_error(response_text: str) -> str:
     """Parse GitHub API error response to get the relevant error message."""
     try:
-        error_data = json.loads(response_text)
+        error_data = orjson.loads(response_text)
         if isinstance(error_data, dict):
             if 'error_details' in error_data:
                 return error_data['error_details'].get('message', '')
             elif 'message' in error_data:
                 return error_data['message']
-    except json.JSONDecodeError:
+    except orjson.JSONDecodeError:
         pass
     return response_text
 
 async def refresh_token(token_index: int = None) -> dict:
-    """Refresh a specific token or the currently active token."""
+    """
+    Refresh a specific token or the currently active token.
+
+    If the active token fails, the following tokens are tried in turn and the
+    first working one becomes active.
+    """
     if token_index is None:
         token_index = get_current_token_index()
-    
+    if token_index < 0 or token_index >= len(get_all_tokens()):
+        raise ValueError(f"Invalid token index: {token_index}")
+
+    if token_index == get_current_token_index():
+        _, token_data = await _find_working_token(token_index)
+        return token_data
+    return await _refresh_one(token_index)
+
+async def _refresh_one(token_index: int) -> dict:
+    """Make a single refresh request for the token at an index."""
     tokens = get_all_tokens()
     if token_index < 0 or token_index >= len(tokens):
         raise ValueError(f"Invalid token index: {token_index}")
 
-    refresh_token_str = tokens[token_index]
+    if not REFRESH_BREAKER.allow_request():
+        raise TokenRefreshError(
+            f"Failed to refresh token at index {token_index}: token endpoint is unavailable, "
+            f"retrying after {REFRESH_BREAKER.cooldown_seconds}s cooldown"
+        )
+
     logger.info(f"Attempting to refresh token at index {token_index}")
 
     try:
-        async with ClientSession() as session:
-            async with session.get(
-                url="https://api.github.com/copilot_internal/v2/token",
-                headers={
-                    "Authorization": "token " + refresh_token_str,
-                    "editor-version": settings.editor_version,
-                },
-            ) as response:
-                response_text = await response.text()
-                if response.status == 200:
-                    token_data = json.loads(response_text)
-                    # Clear any previous error state for this token
-                    if token_index in TOKEN_ERRORS:
-                        del TOKEN_ERRORS[token_index]
-                    return token_data
-                
-                # For non-200 responses, extract the meaningful error message
-                error_message = parse_github_error(response_text)
-                full_error = f"Failed to refresh token at index {token_index}: {response.status} {error_message}"
-                record_token_error(token_index, full_error)
-                
-                if token_index == get_current_token_index():
-                    # If this is the current token, try to switch to next valid token
-                    await try_next_valid_token()
-                    return await refresh_token()
-                
-                raise ValueError(full_error)
+        session = await _get_session()
+        async with session.get(
+            url="https://api.github.com/copilot_internal/v2/token",
+            headers=_auth_headers(settings.refresh_token, settings.editor_version)[
+                token_index
+            ],
+        ) as response:
+            if response.status == 200:
+                # Parse the raw body directly, skipping the str decode. A body
+                # that doesn't parse is a failure, handled below.
+                token_data = orjson.loads(await response.read())
+                REFRESH_BREAKER.on_success()
+                # Clear any previous error state for this token
+                TOKEN_ERRORS.pop(token_index, None)
+                return token_data
+            
+            # Only server-side failures count against the endpoint; a rejected
+            # token means GitHub is up and responding
+            retryable = response.status == 429 or response.status >= 500
+            if retryable:
+                REFRESH_BREAKER.on_failure()
+            else:
+                REFRESH_BREAKER.on_success()
+
+            # For non-200 responses, extract the meaningful error message
+            response_text = await response.text()
+            error_message = parse_github_error(response_text)
+            full_error = f"Failed to refresh token at index {token_index}: {response.status} {error_message}"
+            record_token_error(token_index, full_error)
+            raise TokenRefreshError(
+                full_error, status=response.status, retryable=retryable
+            )
+    except TokenRefreshError:
+        raise
     except Exception as e:
+        REFRESH_BREAKER.on_failure()
         full_error = f"Failed to refresh token at index {token_index}: {str(e)}"
         record_token_error(token_index, full_error)
-        raise ValueError(full_error)
+        raise TokenRefreshError(full_error, retryable=True)
@@ -1,4 +1,4 @@
-from dataclasses import dataclass
+from dataclasses import dataclass, field
 from enum import Enum
 from typing import Optional
 
@@ -12,7 +12,7 @@ class RateLimitBehavior(Enum):
     DELAY = "delay"  # Delay request to stay within limits
 
 
-@dataclass
+@dataclass(slots=True)
 class RateLimitRule:
     window_minutes: int  # Time window in minutes
     input_tokens: Optional[int] = None  # Max input tokens in window
@@ -20,3 +20,7 @@ class RateLimitRule:
     total_tokens: Optional[int] = None  # Max total tokens in window
     requests: Optional[int] = None  # Max requests in window
     behavior: RateLimitBehavior = RateLimitBehavior.ERROR
+    window_seconds: float = field(init=False)  # Window size in seconds
+
+    def __post_init__(self):
+        self.window_seconds = self.window_minutes * 60.0
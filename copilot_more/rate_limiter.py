@@ -1,5 +1,8 @@
+import asyncio
+import time
+from collections import deque
 from datetime import datetime, timedelta
-from typing import Dict, Optional
+from typing import Deque, Dict, Optional
 
 from copilot_more.logger import logger
 from copilot_more.rate_limit_types import (MAX_DELAY_SECONDS,
@@ -13,42 +16,128 @@ class RateLimitError(Exception):
     pass
 
 
+class RequestWindow:
+    """Requests recorded for one model and window size, oldest first, with a running total.
+
+    Timestamps are time.monotonic() seconds.
+    """
+
+    def __init__(self):
+        self.entries: Deque[tuple[float, int]] = deque()
+        self.total = 0
+
+    def add(self, timestamp: float, count: int = 1):
+        self.entries.append((timestamp, count))
+        self.total += count
+
+    def evict_before(self, cutoff: float):
+        """Drop entries older than cutoff from the front of the window"""
+        while self.entries and self.entries[0][0] < cutoff:
+            self.total -= self.entries.popleft()[1]
+
+
+class TokenBucket:
+    """Caps the rate of upstream requests across all models, allowing short bursts.
+
+    Waiters are served in arrival order.
+    """
+
+    def __init__(self, rate: float, capacity: Optional[float] = None):
+        self.rate = rate  # Tokens added per second
+        self.capacity = capacity if capacity is not None else max(1.0, rate)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self._lock = asyncio.Lock()
+
+    async def acquire(self) -> None:
+        """Take one token, waiting until one is available"""
+        async with self._lock:
+            now = time.monotonic()
+            self.tokens = min(
+                self.capacity, self.tokens + (now - self.updated) * self.rate
+            )
+            self.updated = now
+            if self.tokens < 1:
+                delay = (1 - self.tokens) / self.rate
+                logger.info(f"Request rate cap: waiting {delay:.2f} seconds")
+                await asyncio.sleep(delay)
+                # The token accrued while sleeping is the one taken
+                self.tokens = 0.0
+                self.updated = time.monotonic()
+            else:
+                self.tokens -= 1
+
+
 class RateLimiter:
     def __init__(self, token_usage: TokenUsage):
         self.token_usage = token_usage
-        self.request_counters: Dict[str, Dict[int, Dict[datetime, int]]] = {}
+        self.request_counters: Dict[str, Dict[int, RequestWindow]] = {}
         self.rules: Dict[str, list[RateLimitRule]] = {}
-        self.next_allowed_request: Dict[str, datetime] = (
+        # Per-model subsets of rules, precomputed so checks can skip models
+        # without request or token limits entirely
+        self._request_rules: Dict[str, list[RateLimitRule]] = {}
+        self._token_rules: Dict[str, list[RateLimitRule]] = {}
+        self.next_allowed_request: Dict[str, float] = (
             {}
-        )  # Track when next request is allowed per model
+        )  # Track when next request is allowed per model (time.monotonic() seconds)
+        # Models over a token limit with ERROR behavior: (time.monotonic() seconds until
+        # which requests are rejected, reason). Set by check_token_limits.
+        self.blocked_until: Dict[str, tuple[float, str]] = {}
+        # Signalled when limits or recorded usage change, so waiters in acquire re-check
+        self._capacity_changed = asyncio.Condition()
 
     def add_rule(self, model: str, rule: RateLimitRule):
         """Add a rate limit rule for a model"""
         if model not in self.rules:
             self.rules[model] = []
         self.rules[model].append(rule)
+        if rule.requests:
+            self._request_rules.setdefault(model, []).append(rule)
+        if rule.input_tokens or rule.output_tokens or rule.total_tokens:
+            self._token_rules.setdefault(model, []).append(rule)
         logger.info(f"Added rate limit rule for model {model}: {rule}")
 
-    def _check_token_limits(
-        self, model: str, rule: RateLimitRule, start_time: datetime, end_time: datetime
-    ) -> tuple[bool, Optional[dict]]:
-        """
-        Check if token usage is within limits.
-        Returns (is_within_limits, usage_stats)
-        """
-        usage = self.token_usage.query_usage(start_time, end_time, model)
-
+    def _check_token_limits(self, rule: RateLimitRule, usage: dict) -> bool:
+        """Check if token usage for a rule's window is within the rule's limits"""
         if rule.input_tokens and usage["total_input_tokens"] > rule.input_tokens:
-            return False, usage
+            return False
         if rule.output_tokens and usage["total_output_tokens"] > rule.output_tokens:
-            return False, usage
+            return False
         if rule.total_tokens and usage["total_tokens"] > rule.total_tokens:
-            return False, usage
-
-        return True, usage
+            return False
+
+        return True
+
+    def _token_limit_delay(self, rule: RateLimitRule, usage: dict) -> float:
+        """How long to hold back requests after a rule's token limits are exceeded"""
+        # Calculate a proportional delay based on current usage
+        # If we're at 150% of our limit, wait for 50% of the window
+        # If we're at 200% of our limit, wait for the full window
+        usage_ratio = 1.0
+        if usage and rule.total_tokens and usage["total_tokens"] > 0:
+            usage_ratio = usage["total_tokens"] / rule.total_tokens
+        elif usage and rule.input_tokens and usage["total_input_tokens"] > 0:
+            usage_ratio = usage["total_input_tokens"] / rule.input_tokens
+        elif usage and rule.output_tokens and usage["total_output_tokens"] > 0:
+            usage_ratio = usage["total_output_tokens"] / rule.output_tokens
+
+        # Cap the ratio at 2.0 (200%) to prevent excessive delays
+        usage_ratio = min(2.0, usage_ratio)
+
+        # Calculate delay as a portion of the window size
+        # but cap it at MAX_DELAY_SECONDS
+        base_delay = rule.window_seconds * (usage_ratio - 1.0)
+        return min(base_delay, MAX_DELAY_SECONDS)
+
+    def _get_window(self, model: str, window_minutes: int) -> RequestWindow:
+        """Get the request window for a model, creating it if needed"""
+        model_windows = self.request_counters.setdefault(model, {})
+        if window_minutes not in model_windows:
+            model_windows[window_minutes] = RequestWindow()
+        return model_windows[window_minutes]
 
     def _check_request_limits(
-        self, model: str, rule: RateLimitRule, current_time: datetime
+        self, model: str, rule: RateLimitRule, current_time: float
     ) -> tuple[bool, Optional[int]]:
         """
         Check if request count is within limits using a sliding window approach.
@@ -57,94 +146,84 @@ class RateLimiter:
         if not rule.requests:
             return True, None
 
-        if model not in self.request_counters:
-            self.request_counters[model] = {}
-        if rule.window_minutes not in self.request_counters[model]:
-            self.request_counters[model][rule.window_minutes] = {}
-
-        # Get the window start time for our sliding window
-        window_start = current_time - timedelta(minutes=rule.window_minutes)
+        window = self._get_window(model, rule.window_minutes)
 
-        # Clean up entries older than twice the window size to prevent memory growth
-        cleanup_time = current_time - timedelta(minutes=2 * rule.window_minutes)
-        self.request_counters[model][rule.window_minutes] = {
-            ts: count
-            for ts, count in self.request_counters[model][rule.window_minutes].items()
-            if ts >= cleanup_time
-        }
-
-        # Count requests in the sliding window
-        total_requests = sum(
-            count
-            for ts, count in self.request_counters[model][rule.window_minutes].items()
-            if ts >= window_start
-        )
+        # Get the window start time for our sliding window and drop anything older
+        window_start = current_time - rule.window_seconds
+        window.evict_before(window_start)
 
-        return total_requests < rule.requests, total_requests
+        return window.total < rule.requests, window.total
 
     def _calculate_needed_delay(
-        self, model: str, rule: RateLimitRule, current_time: datetime
+        self, model: str, rule: RateLimitRule, current_time: float
     ) -> float:
         """Calculate delay needed to meet rate limits"""
         if not rule.requests:
             return 0.0
 
-        window_start = current_time - timedelta(minutes=rule.window_minutes)
-        counters = self.request_counters.get(model, {}).get(rule.window_minutes, {})
-
-        # Sort timestamps
-        sorted_times = sorted(
-            [ts for ts in counters.keys() if ts >= window_start], reverse=True
-        )
+        window = self.request_counters.get(model, {}).get(rule.window_minutes)
+        if window is None:
+            return 0.0
+        window.evict_before(current_time - rule.window_seconds)
 
-        if len(sorted_times) < rule.requests:
+        if len(window.entries) < rule.requests:
             return 0.0
 
-        # Calculate when the oldest request in our limit will expire
-        oldest_allowed = sorted_times[rule.requests - 1]
-        delay = (
-            oldest_allowed + timedelta(minutes=rule.window_minutes) - current_time
-        ).total_seconds()
+        # Entries are appended in time order, one per request, so the request
+        # that must age out of the window sits rule.requests from the end
+        oldest_allowed = window.entries[-rule.requests][0]
+        delay = oldest_allowed + rule.window_seconds - current_time
         return max(0.0, delay)
 
-    def record_request(self, model: str, current_time: datetime):
-        """Record a request for rate limiting purposes"""
-        if model not in self.request_counters:
-            self.request_counters[model] = {}
-
-        for rule in self.rules.get(model, []):
-            if rule.requests:
-                if rule.window_minutes not in self.request_counters[model]:
-                    self.request_counters[model][rule.window_minutes] = {}
-                window_counters = self.request_counters[model][rule.window_minutes]
-                window_counters[current_time] = window_counters.get(current_time, 0) + 1
+    def record_request(self, model: str, current_time: float):
+        """Record a request for rate limiting purposes at a time.monotonic() timestamp"""
+        # Rules sharing a window size share one counter
+        windows = {
+            rule.window_minutes: rule.window_seconds
+            for rule in self._request_rules.get(model, ())
+        }
+        for window_minutes, window_seconds in windows.items():
+            window = self._get_window(model, window_minutes)
+            # Evict on write as well, so windows stay bounded even while
+            # check_request_limit returns early on a token-limit backoff
+            window.evict_before(current_time - window_seconds)
+            window.add(current_time)
 
     async def check_request_limit(
-        self, model: str, current_time: datetime
+        self, model: str, current_time: float
     ) -> Optional[float]:
         """
         Check request rate limits for a model and return delay needed (if any).
-        Raises RateLimitError if limits are exceeded and behavior is ERROR.
+        current_time is a time.monotonic() timestamp.
+        Raises RateLimitError if limits are exceeded and behavior is ERROR, or while
+        the model is blocked by a token limit with ERROR behavior.
         Returns delay needed in seconds if any limits require delay.
-        Only checks request frequency limits, not token limits.
+        Only checks request frequency limits; token limits are checked by
+        check_token_limits after each response.
         """
+        # Reject requests while a token limit with ERROR behavior is exceeded
+        # Expired entries are left in place rather than deleted, since
+        # check_token_limits may be replacing them from the usage worker thread
+        blocked = self.blocked_until.get(model)
+        if blocked is not None and current_time < blocked[0]:
+            raise RateLimitError(blocked[1])
+
         if model not in self.rules:
             return None
 
         # Check if we need to wait based on previous token limit violations
         if model in self.next_allowed_request:
             if current_time < self.next_allowed_request[model]:
-                delay = (
-                    self.next_allowed_request[model] - current_time
-                ).total_seconds()
+                delay = self.next_allowed_request[model] - current_time
                 return max(0.0, delay)
-        max_delay = 0.0
 
-        for rule in self.rules[model]:
-            # Only check request limits here
-            if not rule.requests:
-                continue
+        request_rules = self._request_rules.get(model)
+        if not request_rules:
+            return None
+
+        max_delay = 0.0
 
+        for rule in request_rules:
             within_request_limits, request_count = self._check_request_limits(
                 model, rule, current_time
             )
@@ -160,54 +239,73 @@ class RateLimiter:
 
         return max_delay if max_delay > 0 else None
 
+    async def acquire(self, model: str) -> None:
+        """
+        Wait until request rate limits allow a request for a model.
+        Raises RateLimitError if limits are exceeded and behavior is ERROR.
+
+        Rather than sleeping out the full computed delay, waiters also wake when
+        notify_waiters is called and re-check the limits.
+        """
+        async with self._capacity_changed:
+            while True:
+                delay = await self.check_request_limit(model, time.monotonic())
+                if not delay:
+                    return
+                logger.info(
+                    f"Request rate limit delay: waiting up to {delay:.2f} seconds"
+                )
+                try:
+                    await asyncio.wait_for(self._capacity_changed.wait(), timeout=delay)
+                except asyncio.TimeoutError:
+                    pass
+
+    async def notify_waiters(self):
+        """Wake requests waiting in acquire so they re-check the limits"""
+        async with self._capacity_changed:
+            self._capacity_changed.notify_all()
+
     def check_token_limits(self, model: str, current_time: datetime) -> Optional[float]:
         """
         Check if current token usage is within limits using a sliding window approach.
+        current_time is wall-clock time, matching the timestamps of recorded usage.
         Returns delay needed in seconds if any rate limits require delay.
-        Raises RateLimitError if exceeded and behavior is ERROR.
+        Raises RateLimitError if exceeded and behavior is ERROR; the model's requests
+        are then rejected by check_request_limit for as long as the delay would be.
         This should be called after each API response with actual usage data.
         """
-        if model not in self.rules:
+        rules = self._token_rules.get(model)
+        if not rules:
             return None
 
         max_delay = 0.0
 
-        for rule in self.rules[model]:
-            window_start = current_time - timedelta(minutes=rule.window_minutes)
-            # Use sliding window for token usage check
-            within_limits, usage = self._check_token_limits(
-                model, rule, window_start, current_time
-            )
+        # Query every rule's sliding window in one pass over the usage store
+        usages = self.token_usage.query_usage_multi(
+            [current_time - timedelta(seconds=rule.window_seconds) for rule in rules],
+            current_time,
+            model,
+        )
 
-            if not within_limits:
+        for rule, usage in zip(rules, usages):
+            if not self._check_token_limits(rule, usage):
+                delay = self._token_limit_delay(rule, usage)
                 if rule.behavior == RateLimitBehavior.ERROR:
-                    raise RateLimitError(
+                    message = (
                         f"Token rate limit exceeded for model {model} in {rule.window_minutes}min sliding window. "
                         f"Usage: {usage}"
                     )
+                    # Later requests fail with this error until the delay has passed
+                    blocked_until = time.monotonic() + delay
+                    previous = self.blocked_until.get(model)
+                    if previous is None or previous[0] < blocked_until:
+                        self.blocked_until[model] = (blocked_until, message)
+                    raise RateLimitError(message)
 
-                # Calculate a proportional delay based on current usage
-                # If we're at 150% of our limit, wait for 50% of the window
-                # If we're at 200% of our limit, wait for the full window
-                usage_ratio = 1.0
-                if usage and rule.total_tokens and usage["total_tokens"] > 0:
-                    usage_ratio = usage["total_tokens"] / rule.total_tokens
-                elif usage and rule.input_tokens and usage["total_input_tokens"] > 0:
-                    usage_ratio = usage["total_input_tokens"] / rule.input_tokens
-                elif usage and rule.output_tokens and usage["total_output_tokens"] > 0:
-                    usage_ratio = usage["total_output_tokens"] / rule.output_tokens
-
-                # Cap the ratio at 2.0 (200%) to prevent excessive delays
-                usage_ratio = min(2.0, usage_ratio)
-
-                # Calculate delay as a portion of the window size
-                # but cap it at MAX_DELAY_SECONDS
-                base_delay = rule.window_minutes * 60.0 * (usage_ratio - 1.0)
-                delay = min(base_delay, MAX_DELAY_SECONDS)
                 max_delay = max(max_delay, delay)
 
                 # Update next allowed request time
-                next_allowed = current_time + timedelta(seconds=delay)
+                next_allowed = time.monotonic() + delay
                 if model in self.next_allowed_request:
                     self.next_allowed_request[model] = max(
                         self.next_allowed_request[model], next_allowed
@@ -1,16 +1,23 @@
 import asyncio
 import json
 import os
+import re
 import signal
-from contextlib import asynccontextmanager, suppress
+import sys
+import time
+import weakref
+from contextlib import asynccontextmanager
 from datetime import datetime, timedelta
-from typing import List, Optional
+from functools import lru_cache
+from typing import AsyncIterator, List, Optional
 import traceback
 
-from aiohttp import ClientSession, ClientTimeout, TCPConnector
+import orjson
+from aiohttp import ClientResponse, ClientSession, ClientTimeout, TCPConnector
 from fastapi import FastAPI, HTTPException, Request, Path
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import StreamingResponse
+from fastapi.middleware.gzip import GZipMiddleware
+from fastapi.responses import ORJSONResponse, Response, StreamingResponse
 from fastapi.staticfiles import StaticFiles
 from pydantic import BaseModel
 from rich import print
@@ -18,6 +25,7 @@ from rich.console import Console
 from rich.table import Table
 
 from copilot_more.access_token import (
+    close_session as close_token_session,
     get_cached_copilot_token,
     refresh_token,
     get_all_tokens,
@@ -25,13 +33,17 @@ from copilot_more.access_token import (
     set_current_token_index,
     get_token_errors,
     try_next_valid_token,
-    record_token_error
+    record_token_error,
+    start_token_refresher,
+    stop_token_refresher,
 )
 from copilot_more.logger import logger
 from copilot_more.proxy import RECORD_TRAFFIC, get_proxy_url, initialize_proxy
 from copilot_more.rate_limiter import (RateLimiter, RateLimitError,
-                                       RateLimitRule)
+                                       RateLimitRule, TokenBucket)
 from copilot_more.settings import settings
+from copilot_more.sse import (SSE_DATA_PREFIX, SSE_DONE, SSE_SEP, SSEParser,
+                              iter_batched)
 from copilot_more.token_counter import TokenUsage
 from copilot_more.utils import StringSanitizer
 
@@ -39,21 +51,80 @@ console = Console()
 
 sanitizer = StringSanitizer()
 
+# Control characters the sanitizer would strip (everything below 0x20 except \t, \n, \r)
+_CONTROL_CHARS = re.compile(r"[\x00-\x08\x0b\x0c\x0e-\x1f]")
+
 initialize_proxy()
 
 # Global trackers
 token_usage = None
 rate_limiter = None
 
+# Stop caches and reverse proxies (e.g. nginx) from buffering streamed responses
+SSE_RESPONSE_HEADERS = {"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+
+# Completions with usage recorded, for printing statistics every Nth one
+completions_recorded = 0
+
+# Static upstream request headers; only the Authorization header varies per request
+MODELS_HEADERS_BASE = {
+    "Content-Type": "application/json",
+    "editor-version": settings.editor_version,
+}
+CHAT_HEADERS_BASE = {
+    "Content-Type": "application/json",
+    "Accept": "text/event-stream",
+    "editor-version": settings.editor_version,
+}
+
+
+@lru_cache(maxsize=4)
+def upstream_headers(token: str, stream: bool) -> dict:
+    """
+    Build upstream request headers for a Copilot token.
+
+    Cached so requests reuse one dict until the token is refreshed.
+    """
+    base = CHAT_HEADERS_BASE if stream else MODELS_HEADERS_BASE
+    return {**base, "Authorization": "Bearer " + token}
+
+
+# Termination signals received so far, and the event loops handlers are installed on
+# (loop.add_signal_handler registers per loop, so a new loop needs them again)
+signals_received = 0
+signal_handler_loops: "weakref.WeakSet[asyncio.AbstractEventLoop]" = weakref.WeakSet()
+
 
 def handle_signal():
+    global signals_received
+    signals_received += 1
+    # For a second signal, exit immediately
+    if signals_received > 1:
+        os._exit(1)
+
     logger.info("Received termination signal. Ctrl+C again to force exit.")
     # Set a short timeout and then force exit
     loop = asyncio.get_running_loop()
     loop.call_later(2.0, os._exit, 0)
-    # For a second signal, exit immediately
-    for sig in (signal.SIGTERM, signal.SIGINT):
-        signal.signal(sig, lambda s, f: os._exit(1))
+
+
+def install_signal_handlers():
+    """Install termination signal handlers, once per running event loop."""
+    loop = asyncio.get_running_loop()
+    if loop in signal_handler_loops:
+        return
+    signal_handler_loops.add(loop)
+
+    # Platform-specific signal handling
+    if sys.platform != "win32":  # Only add signal handlers on non-Windows platforms
+        for sig in (signal.SIGTERM, signal.SIGINT):
+            loop.add_signal_handler(sig, handle_signal)
+    else:
+        # Alternative approach for Windows
+        # Use the default signal handler on Windows
+        for sig in (signal.SIGTERM, signal.SIGINT):
+            signal.signal(sig, lambda s, f: os._exit(0))
+        logger.info("Using standard signal handlers on Windows")
 
 
 @asynccontextmanager
@@ -61,6 +132,7 @@ async def lifespan(app: FastAPI):
     global token_usage, rate_limiter
     # Initialize token usage tracker
     token_usage = TokenUsage()
+    token_usage.start_flusher()
     logger.info("Initialized token usage tracker")
 
     # Initialize rate limiter with settings
@@ -78,6 +150,15 @@ async def lifespan(app: FastAPI):
             rate_limiter.add_rule(model, rule)
     logger.info("Initialized rate limiter with configured rules")
 
+    # Global cap on upstream request rate, independent of per-model rules
+    app.state.request_bucket = (
+        TokenBucket(settings.max_rps) if settings.max_rps else None
+    )
+
+    # Usage of completed responses is recorded in the background
+    app.state.usage_queue = asyncio.Queue()
+    usage_task = asyncio.create_task(usage_worker(app.state.usage_queue))
+
     try:
         await initialize_settings()
     except ValueError as e:
@@ -90,6 +171,11 @@ async def lifespan(app: FastAPI):
             logger.error(f"All tokens failed: {str(e)}")
             # Continue anyway - the frontend will handle token failures
 
+    start_token_refresher()
+
+    # One pooled session for all upstream API calls, so connections are kept alive
+    app.state.http = await create_client_session()
+
     print(
         "[green]Rate limiting is enabled[/green] with the following models configured:"
     )
@@ -103,25 +189,21 @@ async def lifespan(app: FastAPI):
                 f"({limit.behavior.value})"
             )
 
-    # Platform-specific signal handling
-    loop = asyncio.get_running_loop()
-    import sys
-    if sys.platform != 'win32':  # Only add signal handlers on non-Windows platforms
-        for sig in (signal.SIGTERM, signal.SIGINT):
-            loop.add_signal_handler(sig, handle_signal)
-    else:
-        # Alternative approach for Windows
-        # Use the default signal handler on Windows
-        for sig in (signal.SIGTERM, signal.SIGINT):
-            signal.signal(sig, lambda s, f: os._exit(0))
-        logger.info("Using standard signal handlers on Windows")
+    install_signal_handlers()
 
     yield
 
+    # Record usage still queued before stopping the worker
+    await app.state.usage_queue.join()
+    usage_task.cancel()
+    await token_usage.close()
+    await app.state.http.close()
+    await stop_token_refresher()
+    await close_token_session()
     logger.info("Application shutting down normally")
 
 
-app = FastAPI(lifespan=lifespan)
+app = FastAPI(lifespan=lifespan, default_response_class=ORJSONResponse)
 
 app.add_middleware(
     CORSMiddleware,
@@ -130,13 +212,18 @@ app.add_middleware(
     allow_methods=["*"],
     allow_headers=["*"],
 )
+# Compress JSON responses such as /models; event streams are left uncompressed
+# by the middleware so they aren't buffered
+app.add_middleware(GZipMiddleware, minimum_size=512)
 
 
 async def initialize_settings():
     try:
         resp = await refresh_token()
         endpoints = resp["endpoints"]
-        logger.debug(f"Endpoints: {json.dumps(endpoints, indent=2)}")
+        logger.opt(lazy=True).debug(
+            "Endpoints: {}", lambda: json.dumps(endpoints, indent=2)
+        )
         settings.chat_completions_api_endpoint = endpoints["api"] + "/chat/completions"
         settings.models_api_endpoint = endpoints["api"] + "/models"
     except Exception as e:
@@ -144,21 +231,16 @@ async def initialize_settings():
         raise
 
 
-def extract_usage_from_response(data_list: list[dict]) -> dict:
-    """
-    Extract usage statistics from a list of response data objects.
-    Combines usage data from multiple events if present.
+def add_usage_from_event(combined_usage: dict, data: dict) -> None:
     """
-    combined_usage = {"prompt_tokens": 0, "completion_tokens": 0, "total_tokens": 0}
+    Add the usage statistics of one response data object to a running total.
 
-    for data in data_list:
-        usage = data.get("usage", {})
-        if usage:
-            combined_usage["prompt_tokens"] += usage.get("prompt_tokens", 0)
-            combined_usage["completion_tokens"] += usage.get("completion_tokens", 0)
-            combined_usage["total_tokens"] += usage.get("total_tokens", 0)
-
-    return combined_usage
+    combined_usage starts out empty and stays empty until an event carries usage.
+    """
+    usage = data.get("usage")
+    if usage:
+        for key in ("prompt_tokens", "completion_tokens", "total_tokens"):
+            combined_usage[key] = combined_usage.get(key, 0) + usage.get(key, 0)
 
 
 def print_model_usage_statistics(model: str):
@@ -185,9 +267,11 @@ def print_model_usage_statistics(model: str):
     table.add_column("Output Tokens", justify="right", style="yellow")
     table.add_column("Total Tokens", justify="right", style="bold red")
 
-    # Add rows for each time period
-    for period_name, start_time, end_time in time_periods:
-        usage = token_usage.query_usage(start_time, end_time, model)
+    # Add rows for each time period, querying all periods in one pass
+    usages = token_usage.query_usage_multi(
+        [start_time for _, start_time, _ in time_periods], now, model
+    )
+    for (period_name, _, _), usage in zip(time_periods, usages):
         table.add_row(
             period_name,
             f"{usage['total_input_tokens']:,}",
@@ -202,98 +286,164 @@ def print_model_usage_statistics(model: str):
     logger.info(f"Printed usage statistics for model: {model}")
 
 
-def parse_accumulated_sse_data(accumulated_text: str) -> list[dict]:
+def process_usage_and_show_statistics(
+    model: str,
+    usage_data: dict,
+    timestamp: Optional[datetime] = None,
+    show_statistics: bool = True,
+):
     """
-    Parse accumulated SSE text data into a list of JSON objects.
+    Record usage data accumulated from a response and display statistics.
 
     Args:
-        accumulated_text: String containing all SSE data
+        model: The model name
+        usage_data: Combined usage of the response events
+        timestamp: When the response completed, defaults to now
+        show_statistics: Whether to print the model's usage statistics afterwards
+    """
+    # Record the token usage if available
+    if token_usage:
+        token_usage.record_usage_from_response(model, usage_data, timestamp)
+        logger.info(f"Recorded token usage from API stats: {usage_data}")
+
+        # Print usage statistics for different time periods
+        if show_statistics:
+            print_model_usage_statistics(model)
 
-    Returns:
-        List of parsed JSON objects from the SSE data
+
+def record_usage_and_check_limits(
+    model: str, usage_data: dict, completed_at: datetime, show_statistics: bool
+) -> Optional[float]:
     """
-    parsed_events = []
-    parts = accumulated_text.split("\n\n")
+    Record a response's usage, then check the model's token limits including it.
 
-    for part in parts:
-        part = part.strip()
-        if part and part.startswith("data: ") and part != "data: [DONE]":
-            try:
-                json_str = part.replace("data: ", "", 1)
-                parsed_data = json.loads(json_str)
-                parsed_events.append(parsed_data)
-            except json.JSONDecodeError:
-                # Skip invalid JSON
-                logger.error(f"Failed to parse event JSON from part: {part[:100]}...")
+    Both read and write the usage store, so this runs in a worker thread.
+    Returns the delay later requests get, if any; raises RateLimitError for
+    limits with ERROR behavior.
+    """
+    process_usage_and_show_statistics(model, usage_data, completed_at, show_statistics)
+    if rate_limiter:
+        return rate_limiter.check_token_limits(model, completed_at)
+    return None
 
-    return parsed_events
 
+async def usage_worker(queue: asyncio.Queue):
+    """
+    Record usage of completed responses and check token limits, off the response path.
 
-def process_usage_and_show_statistics(model: str, parsed_events: list[dict]):
+    Items are (model, usage_data, completed_at). A token limit that is hit affects
+    later requests rather than the response that hit it: with DELAY behavior they
+    wait in the rate limiter, with ERROR behavior they are rejected with a 429.
     """
-    Process usage data from parsed events and display statistics.
+    global completions_recorded
+    while True:
+        model, usage_data, completed_at = await queue.get()
+        try:
+            # Counted here on the event loop, so the worker thread shares no state
+            completions_recorded += 1
+            interval = settings.usage_stats_interval
+            show_statistics = bool(interval) and completions_recorded % interval == 0
+
+            token_delay = await asyncio.to_thread(
+                record_usage_and_check_limits,
+                model,
+                usage_data,
+                completed_at,
+                show_statistics,
+            )
+            if token_delay:
+                logger.info(
+                    f"Token rate limit: delaying requests for {model} by {token_delay:.2f} seconds"
+                )
+        except RateLimitError as e:
+            logger.warning(f"{e}. Rejecting requests for {model} for now")
+        except Exception as e:
+            logger.error(f"Error processing usage for {model}: {str(e)}")
+        finally:
+            queue.task_done()
+        if rate_limiter:
+            await rate_limiter.notify_waiters()
 
-    Args:
-        model: The model name
-        parsed_events: List of parsed SSE events
+
+# Longer texts are sanitized without caching, so the cache can't pin large prompts
+SANITIZE_CACHE_MAX_LENGTH = 64 * 1024
+
+
+def sanitize_text(text: str) -> str:
     """
-    if not parsed_events:
-        return
+    Sanitize message text, skipping the full sanitizer for text it would only strip.
 
-    usage_data = extract_usage_from_response(parsed_events)
+    Results are cached so recurring strings such as system prompts are sanitized once.
+    """
+    if len(text) > SANITIZE_CACHE_MAX_LENGTH:
+        return _sanitize_text(text)
+    return _sanitize_text_cached(text)
 
-    # Record the token usage if available
-    if token_usage and usage_data:
-        token_usage.record_usage_from_response(model, usage_data)
-        logger.info(f"Recorded token usage from API stats: {json.dumps(usage_data)}")
 
-        # Print usage statistics for different time periods
-        print_model_usage_statistics(model)
+def _sanitize_text(text: str) -> str:
+    # Plain ASCII without escape sequences or control characters is unaffected
+    # by every sanitizer step except the final strip()
+    if text.isascii() and "\\u" not in text and not _CONTROL_CHARS.search(text):
+        return text.strip()
+
+    result = sanitizer.sanitize(text)
+    if not result.success:
+        logger.warning(f"String sanitization warnings: {result.warnings}")
+    return result.text
+
 
+_sanitize_text_cached = lru_cache(maxsize=1024)(_sanitize_text)
 
-def preprocess_request_body(request_body: dict) -> dict:
+
+def preprocess_request_body(request_body: dict, is_o1: Optional[bool] = None) -> dict:
     """
     Preprocess the request body to handle array content in messages.
+
+    The body is updated in place and returned. is_o1 can be passed by callers
+    that have already checked the model, otherwise it is derived from the body.
     """
     if not request_body.get("messages"):
         return request_body
 
-    processed_messages = []
+    # Messages are updated in place; a new list is only built once a message
+    # with array content has to be expanded into several messages
+    messages = request_body["messages"]
+    processed_messages: Optional[list] = None
+
+    # o1 models don't support system messages
+    if is_o1 is None:
+        model: str = request_body.get("model", "")
+        is_o1 = bool(model) and model.startswith("o1")
 
-    for message in request_body["messages"]:
+    for i, message in enumerate(messages):
         if not isinstance(message.get("content"), list):
             content = message["content"]
             if isinstance(content, str):
-                result = sanitizer.sanitize(content)
-                if not result.success:
-                    logger.warning(f"String sanitization warnings: {result.warnings}")
-                content = result.text
+                content = sanitize_text(content)
             message["content"] = content
-            processed_messages.append(message)
+            if is_o1 and message["role"] == "system":
+                message["role"] = "user"
+            if processed_messages is not None:
+                processed_messages.append(message)
             continue
 
+        if processed_messages is None:
+            processed_messages = messages[:i]
+        role = "user" if is_o1 and message["role"] == "system" else message["role"]
         for content_item in message["content"]:
             if content_item.get("type") != "text":
                 raise HTTPException(400, "Only text type is supported in content array")
 
             text = content_item["text"]
             if isinstance(text, str):
-                result = sanitizer.sanitize(text)
-                if not result.success:
-                    logger.warning(f"String sanitization warnings: {result.warnings}")
-                text = result.text
+                text = sanitize_text(text)
 
-            processed_messages.append({"role": message["role"], "content": text})
-
-    # o1 models don't support system messages
-    model: str = request_body.get("model", "")
-    if model and model.startswith("o1"):
-        for message in processed_messages:
-            if message["role"] == "system":
-                message["role"] = "user"
+            processed_messages.append({"role": role, "content": text})
 
-    max_tokens = request_body.get("max_tokens", settings.max_tokens)
-    return {**request_body, "messages": processed_messages, "max_tokens": max_tokens}
+    if processed_messages is not None:
+        request_body["messages"] = processed_messages
+    request_body.setdefault("max_tokens", settings.max_tokens)
+    return request_body
 
 
 # o1 models only support non-streaming responses, we need to convert them to standard streaming format
@@ -320,8 +470,8 @@ def convert_o1_response(data: dict) -> dict:
     return {**data, "choices": converted_choices}
 
 
-def convert_to_sse_events(data: dict) -> list[str]:
-    """Convert response data to SSE events"""
+def convert_to_sse_events(data: dict) -> list[bytes]:
+    """Convert response data to encoded SSE events"""
     events = []
     if "choices" in data:
         for choice in data["choices"]:
@@ -331,13 +481,19 @@ def convert_to_sse_events(data: dict) -> list[str]:
                 "model": data.get("model", ""),
                 "choices": [choice],
             }
-            events.append(f"data: {json.dumps(event_data)}\n\n")
-    events.append("data: [DONE]\n\n")
+            events.append(SSE_DATA_PREFIX + orjson.dumps(event_data) + SSE_SEP)
+    events.append(SSE_DONE + SSE_SEP)
     return events
 
 
 async def create_client_session() -> ClientSession:
-    connector = TCPConnector(ssl=False) if get_proxy_url() else TCPConnector()
+    connector = TCPConnector(
+        ssl=False if get_proxy_url() else None,
+        limit=settings.tcp_connector_limit,
+        limit_per_host=settings.tcp_connector_limit_per_host,
+        keepalive_timeout=75,
+        ttl_dns_cache=300,
+    )
     return ClientSession(
         timeout=ClientTimeout(total=settings.timeout_seconds), connector=connector
     )
@@ -350,39 +506,68 @@ async def execute_rate_limit_sleep(delay: float, reason: str = "Rate limit") ->
     logger.info(f"{reason} delay: waiting {delay:.2f} seconds")
 
     try:
-        with suppress(asyncio.CancelledError):
-            await asyncio.sleep(delay)
+        await asyncio.sleep(delay)
     except asyncio.CancelledError:
         logger.info(f"{reason} delay interrupted")
         raise HTTPException(499, "Request cancelled by client")
 
 
+async def stream_o1(response: ClientResponse, usage_data: dict) -> AsyncIterator[bytes]:
+    """
+    Read a complete o1 response and send it as SSE events, totalling usage into usage_data.
+    """
+    data = orjson.loads(await response.read())
+    # Usage comes straight from the response; the converted events don't carry it
+    add_usage_from_event(usage_data, data)
+    converted_data = convert_o1_response(data)
+    # The whole response is already in hand, so send it in one write
+    yield b"".join(convert_to_sse_events(converted_data))
+
+
+async def stream_passthrough(
+    response: ClientResponse, usage_data: dict
+) -> AsyncIterator[bytes]:
+    """
+    Pass a streamed response through, totalling usage into usage_data.
+    """
+    # Usage is totalled as events are parsed, so no events are retained
+    sse_parser = SSEParser()
+    # Stream chunks through, batching small ones so each write carries several events
+    async for chunk_data in iter_batched(
+        response.content, settings.sse_batch_bytes, settings.sse_batch_ms / 1000
+    ):
+        yield chunk_data
+
+        # Parse events as they complete rather than re-scanning
+        # the whole stream at the end
+        for event in sse_parser.feed(chunk_data):
+            add_usage_from_event(usage_data, event)
+
+
 @app.get("/models")
-async def list_models():
+async def list_models(request: Request):
     """
     Proxies models request.
     """
     try:
         token = await get_cached_copilot_token()
-        session = await create_client_session()
-        async with session as s:
-            kwargs = {
-                "headers": {
-                    "Authorization": f"Bearer {token['token']}",
-                    "Content-Type": "application/json",
-                    "editor-version": settings.editor_version,
-                }
-            }
-            if RECORD_TRAFFIC:
-                kwargs["proxy"] = get_proxy_url()
-            async with s.get(settings.models_api_endpoint, **kwargs) as response:
-                if response.status != 200:
-                    error_message = await response.text()
-                    logger.error(f"Models API error: {error_message}")
-                    raise HTTPException(
-                        response.status, f"Models API error: {error_message}"
-                    )
-                return await response.json()
+        s: ClientSession = request.app.state.http
+        kwargs = {"headers": upstream_headers(token["token"], stream=False)}
+        if RECORD_TRAFFIC:
+            kwargs["proxy"] = get_proxy_url()
+        async with s.get(settings.models_api_endpoint, **kwargs) as response:
+            if response.status != 200:
+                error_message = await response.text()
+                logger.error(f"Models API error: {error_message}")
+                raise HTTPException(
+                    response.status, f"Models API error: {error_message}"
+                )
+            # Pass the upstream JSON through as-is rather than decoding and re-encoding it
+            return Response(
+                content=await response.read(),
+                media_type="application/json",
+                status_code=response.status,
+            )
     except Exception as e:
         logger.error(f"Error fetching models: {str(e)}")
         raise HTTPException(500, f"Error fetching models: {str(e)}")
@@ -482,39 +667,45 @@ async def proxy_chat_completions(request: Request):
     """
     Proxies chat completion requests with SSE support.
     """
-    request_body = await request.json()
-    logger.debug(f"Received request: {json.dumps(request_body, indent=2)}")
+    request_body = orjson.loads(await request.body())
+    # Only pretty-print the body if DEBUG logging is enabled
+    logger.opt(lazy=True).debug(
+        "Received request: {}", lambda: json.dumps(request_body, indent=2)
+    )
+
+    # Get model and the per-request model predicates once
+    model = request_body.get("model", "")
+    is_o1 = bool(model) and model.startswith("o1")
 
     try:
-        request_body = preprocess_request_body(request_body)
+        request_body = preprocess_request_body(request_body, is_o1)
     except HTTPException as e:
         raise e
     except Exception as e:
         raise HTTPException(400, f"Error preprocessing request: {str(e)}")
 
-    # Get model
-    model = request_body.get("model", "")
-
     # Check request rate limits only
     if not rate_limiter:
         raise HTTPException(500, "Rate limiter is not initialized")
 
     assert rate_limiter is not None  # Help mypy understand the type
-    current_time = datetime.now()
     try:
-        delay = await rate_limiter.check_request_limit(model, current_time)
-        if delay:
-            await execute_rate_limit_sleep(delay, "Request rate limit")
+        await rate_limiter.acquire(model)
+        if request.app.state.request_bucket:
+            await request.app.state.request_bucket.acquire()
     except RateLimitError as e:
         raise HTTPException(429, str(e))
+    except asyncio.CancelledError:
+        logger.info("Request rate limit delay interrupted")
+        raise HTTPException(499, "Request cancelled by client")
+
+    # Pick the response handler once; o1 models only answer non-streaming
+    is_streaming = request_body.get("stream", False)
+    stream_handler = stream_o1 if is_o1 and is_streaming else stream_passthrough
 
     async def stream_response():
         try:
             token = await get_cached_copilot_token()
-            is_streaming = request_body.get("stream", False)
-
-            # Storage for accumulated chunks for both model types
-            all_text_chunks = ""
 
             # Apply configured sleep between API calls
             if settings.sleep_between_calls > 0:
@@ -522,78 +713,48 @@ async def proxy_chat_completions(request: Request):
                     settings.sleep_between_calls, "API call spacing"
                 )
 
-            session = await create_client_session()
-            async with session as s:
-                kwargs = {
-                    "json": request_body,
-                    "headers": {
-                        "Authorization": f"Bearer {token['token']}",
-                        "Content-Type": "application/json",
-                        "Accept": "text/event-stream",
-                        "editor-version": settings.editor_version,
-                    },
-                }
-                if RECORD_TRAFFIC:
-                    kwargs["proxy"] = get_proxy_url()
-                async with s.post(
-                    settings.chat_completions_api_endpoint, **kwargs
-                ) as response:
-                    if response.status != 200:
-                        error_message = await response.text()
-                        logger.error(f"API error: {error_message}")
-                        raise HTTPException(
-                            response.status, f"API error: {error_message}"
-                        )
-
-                    if model.startswith("o1") and is_streaming:
-                        # For o1 models with streaming, read entire response and convert to SSE
-                        data = await response.json()
-                        converted_data = convert_o1_response(data)
-                        for event in convert_to_sse_events(converted_data):
-                            encoded_event = event.encode("utf-8")
-                            yield encoded_event
-
-                            # Accumulate text representations of events
-                            if isinstance(encoded_event, bytes):
-                                all_text_chunks += encoded_event.decode("utf-8")
-                            else:
-                                all_text_chunks += encoded_event
-                    else:
-                        # For other cases, stream chunks directly
-                        async for chunk in response.content.iter_chunks():
-                            if chunk:
-                                chunk_data = chunk[0]
-                                yield chunk_data
-
-                                # Accumulate text representations of chunks
-                                if isinstance(chunk_data, bytes):
-                                    all_text_chunks += chunk_data.decode("utf-8")
-                                else:
-                                    all_text_chunks += chunk_data
-
-                    parsed_events = parse_accumulated_sse_data(all_text_chunks)
-
-                    # Process usage data, check token limits, record the request, and show statistics
-                    process_usage_and_show_statistics(model, parsed_events)
-                    if rate_limiter:
-                        current_time = datetime.now()
-                        # Check token limits first as it may affect future requests
-                        token_delay = rate_limiter.check_token_limits(
-                            model, current_time
-                        )
-                        if token_delay and token_delay > 0:
-                            await execute_rate_limit_sleep(
-                                token_delay, "Token rate limit"
-                            )
-                        rate_limiter.record_request(model, current_time)
+            s: ClientSession = request.app.state.http
+            kwargs = {
+                "data": orjson.dumps(request_body),
+                "headers": upstream_headers(token["token"], stream=True),
+            }
+            if RECORD_TRAFFIC:
+                kwargs["proxy"] = get_proxy_url()
+            async with s.post(
+                settings.chat_completions_api_endpoint, **kwargs
+            ) as response:
+                if response.status != 200:
+                    error_message = await response.text()
+                    logger.error(f"API error: {error_message}")
+                    raise HTTPException(
+                        response.status, f"API error: {error_message}"
+                    )
+
+                usage_data: dict = {}
+                async for chunk_data in stream_handler(response, usage_data):
+                    yield chunk_data
+
+                # Record the request now, and queue the usage data to be recorded,
+                # checked against token limits and shown in the background.
+                # One completion timestamp for both, so the token check's window
+                # always ends at the usage just recorded
+                completed_at = datetime.now()
+                if rate_limiter:
+                    rate_limiter.record_request(model, time.monotonic())
+                    await rate_limiter.notify_waiters()
+                if usage_data:
+                    request.app.state.usage_queue.put_nowait(
+                        (model, usage_data, completed_at)
+                    )
 
         except Exception as e:
             logger.error(f"Error in stream_response: {str(e)}")
-            yield json.dumps({"error": str(e)}).encode("utf-8")
+            yield orjson.dumps({"error": str(e)})
 
     return StreamingResponse(
         stream_response(),
         media_type="text/event-stream",
+        headers=SSE_RESPONSE_HEADERS,
     )
 
 from fastapi.responses import FileResponse
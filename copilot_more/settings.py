@@ -2,13 +2,16 @@
 Settings module for copilot-more using pydantic-settings for configuration management.
 """
 
-import json
 import os
+import re
 import sys
 from functools import lru_cache
-from typing import Dict, List, Optional
+from typing import Dict, Optional, Tuple
 
-from pydantic import BaseModel, Field, NonNegativeFloat, field_validator
+import orjson
+from pydantic import (AliasChoices, BaseModel, ConfigDict, Field,
+                      NonNegativeFloat, NonNegativeInt, TypeAdapter,
+                      field_validator)
 from pydantic_settings import BaseSettings, SettingsConfigDict
 
 from copilot_more.rate_limit_types import RateLimitBehavior
@@ -17,6 +20,9 @@ from copilot_more.rate_limit_types import RateLimitBehavior
 class RateLimitSettings(BaseModel):
     """Rate limit settings for a specific time window"""
 
+    # Loaded limits are shared between Settings instances, so they can't be changed
+    model_config = ConfigDict(frozen=True)
+
     window_minutes: int = Field(..., gt=0, description="Time window in minutes")
     input_tokens: Optional[int] = Field(
         None, gt=0, description="Max input tokens in window"
@@ -33,6 +39,42 @@ class RateLimitSettings(BaseModel):
         description="What to do when limit is hit: error or delay",
     )
 
+    @field_validator("behavior", mode="before")
+    def lowercase_behavior(cls, v):
+        """Accept behavior names in any case"""
+        return v.lower() if isinstance(v, str) else v
+
+
+# Validates a whole rate limits file in one call
+_RATE_LIMITS_ADAPTER = TypeAdapter(Dict[str, Tuple[RateLimitSettings, ...]])
+
+
+# Every GitHub OAuth token starts with this
+_GHO_PREFIX = "gho_"
+
+# Where rate limits are read from unless RATE_LIMITS_FILE is set
+RATE_LIMITS_PATH = os.path.join(
+    os.path.dirname(os.path.dirname(__file__)), "rate_limits.json"
+)
+
+# ${VAR} references substituted into the rate limits file; bare $VAR is left as is
+_ENV_REFERENCE = re.compile(r"\$\{(\w+)\}")
+
+
+def _interpolate_env(raw: str) -> str:
+    """Replace ${VAR} references with environment values, failing on undefined ones"""
+    missing = sorted(
+        {name for name in _ENV_REFERENCE.findall(raw) if name not in os.environ}
+    )
+    if missing:
+        raise ValueError(f"undefined environment variables: {', '.join(missing)}")
+    return _ENV_REFERENCE.sub(lambda match: os.environ[match.group(1)], raw)
+
+
+# Raw contents of the last rate limits file loaded and the limits built from it,
+# so constructing Settings again skips parsing and validating an unchanged file
+_rate_limits_cache: Optional[tuple[str, Dict[str, Tuple[RateLimitSettings, ...]]]] = None
+
 
 class Settings(BaseSettings):
     """
@@ -68,6 +110,26 @@ class Settings(BaseSettings):
     timeout_seconds: int = Field(
         default=300, description="Timeout for API requests in seconds"
     )
+    tcp_connector_limit: NonNegativeInt = Field(
+        default=0,
+        validation_alias=AliasChoices("tcp_connector_limit", "connection_pool_limit"),
+        description="Max concurrent upstream connections (0 for unlimited)",
+    )
+    tcp_connector_limit_per_host: NonNegativeInt = Field(
+        default=0,
+        validation_alias=AliasChoices(
+            "tcp_connector_limit_per_host", "connection_pool_limit_per_host"
+        ),
+        description="Max concurrent upstream connections per host (0 for unlimited)",
+    )
+    sse_batch_bytes: NonNegativeInt = Field(
+        default=4096,
+        description="Send held-back streamed chunks once this many bytes are pending",
+    )
+    sse_batch_ms: NonNegativeInt = Field(
+        default=0,
+        description="Max milliseconds of latency added by holding back streamed chunks (0 to disable batching)",
+    )
 
     # Proxy and traffic recording settings
     record_traffic: bool = Field(
@@ -75,36 +137,36 @@ class Settings(BaseSettings):
     )
 
     # Rate limiting settings from external JSON file
-    rate_limits: Dict[str, List[RateLimitSettings]] = Field(
-        default_factory=lambda: Settings._load_rate_limits(),
+    rate_limits_file: str = Field(
+        default_factory=lambda: RATE_LIMITS_PATH,
+        description="Path of the rate limits JSON file",
+    )
+    rate_limits: Dict[str, Tuple[RateLimitSettings, ...]] = Field(
+        default_factory=lambda data: Settings._load_rate_limits(
+            data["rate_limits_file"]
+        ),
         description="Rate limits configuration per model",
     )
 
     @staticmethod
-    def _load_rate_limits() -> Dict[str, List[RateLimitSettings]]:
+    def _load_rate_limits(config_path: str) -> Dict[str, Tuple[RateLimitSettings, ...]]:
         """Load rate limits from external JSON file"""
-        converted_limits: Dict[str, List[RateLimitSettings]] = {}
+        global _rate_limits_cache
+        converted_limits: Dict[str, Tuple[RateLimitSettings, ...]] = {}
         try:
-            config_path = os.path.join(
-                os.path.dirname(os.path.dirname(__file__)), "rate_limits.json"
-            )
             if os.path.exists(config_path):
-                with open(config_path, "r") as f:
-                    rate_limits_data = json.load(f)
+                with open(config_path, encoding="utf-8") as f:
+                    raw = f.read()
+                # Interpolate ${ENV_VAR} references, skipping the scan when there are none
+                if "${" in raw:
+                    raw = _interpolate_env(raw)
+                if _rate_limits_cache is not None and _rate_limits_cache[0] == raw:
+                    return _rate_limits_cache[1]
+                rate_limits_data = orjson.loads(raw)
 
                 # Convert the loaded data to RateLimitSettings objects
-                for model, limits in rate_limits_data.items():
-                    converted_limits[model] = [
-                        RateLimitSettings(
-                            window_minutes=limit["window_minutes"],
-                            total_tokens=limit.get("total_tokens"),
-                            input_tokens=limit.get("input_tokens"),
-                            output_tokens=limit.get("output_tokens"),
-                            requests=limit.get("requests"),
-                            behavior=RateLimitBehavior(limit.get("behavior").lower()),
-                        )
-                        for limit in limits
-                    ]
+                converted_limits = _RATE_LIMITS_ADAPTER.validate_python(rate_limits_data)
+                _rate_limits_cache = (raw, converted_limits)
                 print(f"Loaded rate limits from {config_path}", file=sys.stderr)
             else:
                 print(
@@ -133,12 +195,20 @@ class Settings(BaseSettings):
     loguru_level: str = Field(
         default="INFO", description="Loguru logging level (default: INFO)"
     )
+    usage_stats_interval: NonNegativeInt = Field(
+        default=1,
+        description="Print usage statistics after every Nth completion (0 to disable)",
+    )
 
     # Sleep setting between API calls
     sleep_between_calls: NonNegativeFloat = Field(
         default=0.0,
         description="Sleep duration in seconds between API calls",
     )
+    max_rps: NonNegativeFloat = Field(
+        default=0.0,
+        description="Max upstream chat requests per second across all models (0 for unlimited)",
+    )
 
     # Pydantic model configuration
     model_config = SettingsConfigDict(
@@ -154,16 +224,20 @@ class Settings(BaseSettings):
         if not v:
             raise ValueError("REFRESH_TOKEN environment variable is required")
 
-        tokens = [token.strip() for token in v.split(",")]
-        if not tokens:
-            raise ValueError("At least one refresh token must be provided")
-
-        for token in tokens:
-            if not token.startswith("gho_"):
-                raise ValueError(
-                    f"All tokens must be GitHub OAuth tokens starting with 'gho_'. Invalid token: {token[:4]}..."
-                )
-        return v
+        invalid = next(
+            (
+                token
+                for token in map(str.strip, v.split(","))
+                if not token.startswith(_GHO_PREFIX)
+            ),
+            None,
+        )
+        if invalid is None:
+            return v
+        raise ValueError(
+            f"REFRESH_TOKEN should be a GitHub OAuth token starting with 'gho_' "
+            f"(comma-separate multiple tokens). Invalid token: {invalid[:4]}..."
+        )
 
     @field_validator("active_token_index")
     def validate_active_token_index(cls, v: int, values) -> int:
@@ -204,5 +278,12 @@ def get_settings() -> Settings:
     return settings
 
 
-# Create a global instance for direct import in most cases
-settings = get_settings()
+def __getattr__(name: str):
+    """
+    Create the global settings instance on first use (`from copilot_more.settings import settings`).
+
+    Importing the module alone doesn't read the environment or the rate limits file.
+    """
+    if name == "settings":
+        return get_settings()
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
@@ -0,0 +1,112 @@
+import asyncio
+from typing import AsyncIterator, Iterator
+
+import orjson
+from aiohttp import StreamReader
+
+from copilot_more.logger import logger
+
+SSE_DATA_PREFIX = b"data: "
+SSE_DONE = b"data: [DONE]"
+SSE_SEP = b"\n\n"
+
+# Whitespace around an event, as removed by bytes.strip()
+_WHITESPACE = b" \t\n\r\x0b\x0c"
+
+
+class SSEParser:
+    """
+    Incremental parser for server-sent event streams.
+
+    Bytes are fed in as they arrive and each complete event is parsed once,
+    so the stream never has to be held in memory or re-scanned.
+    """
+
+    def __init__(self):
+        # Bytes of the event currently being received
+        self.buffer = bytearray()
+        # Offset before which the buffer is known not to contain a separator
+        self.scan_from = 0
+
+    def feed(self, data: bytes) -> Iterator[dict]:
+        """
+        Add received bytes and yield the JSON payload of each event they complete.
+
+        Non-data events, the [DONE] terminator and invalid JSON are skipped.
+        """
+        buffer = self.buffer
+        buffer.extend(data)
+
+        # Walk the complete events by offset and parse payloads from a view of
+        # the buffer, then drop them all at once, so nothing is copied per event
+        consumed = 0
+        view = memoryview(buffer)
+        try:
+            while (end := buffer.find(SSE_SEP, max(consumed, self.scan_from))) != -1:
+                start, stop = consumed, end
+                consumed = end + len(SSE_SEP)
+                while start < stop and buffer[start] in _WHITESPACE:
+                    start += 1
+                while stop > start and buffer[stop - 1] in _WHITESPACE:
+                    stop -= 1
+
+                if not buffer.startswith(SSE_DATA_PREFIX, start, stop) or (
+                    stop - start == len(SSE_DONE) and buffer.startswith(SSE_DONE, start)
+                ):
+                    continue
+                try:
+                    yield orjson.loads(view[start + len(SSE_DATA_PREFIX) : stop])
+                except orjson.JSONDecodeError:
+                    # Skip invalid JSON
+                    logger.error(
+                        f"Failed to parse event JSON from part: {bytes(view[start:min(stop, start + 100)])!r}..."
+                    )
+        finally:
+            view.release()
+            del buffer[:consumed]
+            # A long event arriving in many chunks isn't rescanned from its start;
+            # back off by one byte in case the separator straddles the next chunk
+            self.scan_from = max(0, len(buffer) - len(SSE_SEP) + 1)
+
+
+async def iter_batched(
+    content: StreamReader, max_bytes: int, max_delay: float
+) -> AsyncIterator[bytes]:
+    """
+    Yield the bytes of a response body, holding back small chunks to send together.
+
+    Data is yielded once max_bytes have accumulated or max_delay seconds after
+    the oldest held-back chunk arrived, whichever comes first. A zero delay
+    disables batching and yields chunks as they arrive.
+    """
+    if max_delay <= 0:
+        async for chunk in content.iter_any():
+            yield chunk
+        return
+
+    loop = asyncio.get_running_loop()
+    pending = bytearray()
+    flush_at = 0.0
+    while True:
+        if pending:
+            try:
+                chunk = await asyncio.wait_for(
+                    content.readany(), timeout=max(0.0, flush_at - loop.time())
+                )
+            except asyncio.TimeoutError:
+                yield bytes(pending)
+                pending.clear()
+                continue
+        else:
+            chunk = await content.readany()
+            flush_at = loop.time() + max_delay
+
+        if not chunk:
+            break
+        pending.extend(chunk)
+        if len(pending) >= max_bytes:
+            yield bytes(pending)
+            pending.clear()
+
+    if pending:
+        yield bytes(pending)
@@ -1,197 +1,543 @@
+import asyncio
+import glob
+import operator
+import os
+import threading
+import time
 import uuid
-from datetime import datetime
-from typing import Dict, List, Optional
+from bisect import bisect_left, bisect_right
+from datetime import datetime, timedelta
+from functools import reduce
+from typing import Dict, List, Optional, Tuple
 
 import pandas as pd
-import pystore  # type: ignore
+import pyarrow as pa  # type: ignore
+import pyarrow.compute as pc  # type: ignore
+import pyarrow.dataset as ds  # type: ignore
+import pyarrow.parquet as pq  # type: ignore
 
 from copilot_more.logger import logger
 
 
-class TokenUsage:
+# How much recent usage is kept in memory; covers the longest statistics period
+USAGE_WINDOW_RETENTION = timedelta(days=1)
+
+# Usage records are appended as parquet files, partitioned by day
+USAGE_DATA_PATH = "data/usage"
+# Where earlier versions kept usage in PyStore; migrated once on startup
+PYSTORE_PATH = "data/token_usage"
+
+USAGE_SCHEMA = pa.schema(
+    [
+        ("timestamp", pa.timestamp("us")),
+        ("record_id", pa.string()),
+        ("model", pa.string()),
+        ("input_tokens", pa.int64()),
+        ("output_tokens", pa.int64()),
+        ("total_tokens", pa.int64()),
+    ]
+)
+USAGE_PARTITIONING = ds.partitioning(pa.schema([("date", pa.string())]), flavor="hive")
+# The records as read back, with the date partition key as a column
+USAGE_DATASET_SCHEMA = USAGE_SCHEMA.append(pa.field("date", pa.string()))
+# The columns totalled by usage queries
+TOKEN_COLUMNS = ("input_tokens", "output_tokens", "total_tokens")
+
+
+# How long the list of models with usage data is reused before rescanning the store
+AVAILABLE_MODELS_TTL_SECONDS = 60
+
+# Recorded usage is written out in batches, at least this often
+FLUSH_INTERVAL_SECONDS = 0.5
+# and as soon as this many records are pending
+FLUSH_MAX_RECORDS = 256
+
+
+def _usage_table(columns: dict) -> pa.Table:
+    """Build a table of usage records, with the date column it is partitioned by."""
+    table = pa.table(columns, schema=USAGE_SCHEMA)
+    return table.append_column(
+        "date", pc.strftime(table["timestamp"], format="%Y-%m-%d")
+    )
+
+
+class UsageWindow:
+    """
+    Recent usage records, oldest first, with running totals.
+
+    The totals for any time range are the difference of two running totals,
+    found by binary search, so queries don't scan the records.
+    """
+
     def __init__(self):
-        # Initialize PyStore
-        pystore.set_path("data/token_usage")
-        self.store = pystore.store("token_metrics")
-        self.collection = self.store.collection("usage")
-
-    def _item_exists(self, item_name: str) -> bool:
-        """Check if an item exists in the collection."""
-        return item_name in self.collection.list_items()
-
-    def record_usage(self, model: str, input_tokens: int, output_tokens: int):
-        """Record token usage for a specific model."""
-        timestamp = datetime.now()
-        record_id = str(uuid.uuid4())  # Generate unique ID for this record
+        self.timestamps: List[datetime] = []
+        # Running (input, output, total, count) up to and including each record
+        self.cumulative: List[Tuple[int, int, int, int]] = []
+        # Running totals before the first retained record
+        self.base: Tuple[int, int, int, int] = (0, 0, 0, 0)
+
+    def add(self, timestamp: datetime, input_tokens: int, output_tokens: int):
+        # Records normally arrive in time order, but a caller-supplied timestamp or
+        # a wall clock stepping back can place one before newer records
+        position = bisect_right(self.timestamps, timestamp)
+        before = self.cumulative[position - 1] if position else self.base
+        self.timestamps.insert(position, timestamp)
+        self.cumulative.insert(
+            position,
+            (
+                before[0] + input_tokens,
+                before[1] + output_tokens,
+                before[2] + input_tokens + output_tokens,
+                before[3] + 1,
+            ),
+        )
+        # The running totals of any newer records now include this one
+        total_tokens = input_tokens + output_tokens
+        for i in range(position + 1, len(self.cumulative)):
+            running = self.cumulative[i]
+            self.cumulative[i] = (
+                running[0] + input_tokens,
+                running[1] + output_tokens,
+                running[2] + total_tokens,
+                running[3] + 1,
+            )
 
-        data_dict = {
-            "record_id": [record_id],
-            "model": [model],
-            "input_tokens": [input_tokens],
-            "output_tokens": [output_tokens],
-            "total_tokens": [input_tokens + output_tokens],
-        }
+    def evict_before(self, cutoff: datetime):
+        """Drop records older than cutoff"""
+        evicted = bisect_left(self.timestamps, cutoff)
+        if evicted:
+            self.base = self.cumulative[evicted - 1]
+            del self.timestamps[:evicted]
+            del self.cumulative[:evicted]
+
+    def totals(
+        self, start_time: datetime, end_time: datetime
+    ) -> Tuple[int, int, int, int]:
+        """Return (input, output, total, count) for records in [start_time, end_time]"""
+        lo = bisect_left(self.timestamps, start_time)
+        hi = bisect_right(self.timestamps, end_time)
+        before = self.cumulative[lo - 1] if lo else self.base
+        upto = self.cumulative[hi - 1] if hi else self.base
+        return (
+            upto[0] - before[0],
+            upto[1] - before[1],
+            upto[2] - before[2],
+            upto[3] - before[3],
+        )
 
-        # Convert to DataFrame with timestamp as index
-        new_data = pd.DataFrame(data_dict, index=[timestamp])
 
-        # Store in PyStore with timestamp as index
+class TokenUsage:
+    def __init__(self, path: str = USAGE_DATA_PATH):
+        self.path = path
+        # Whether the dataset directory exists; once it does, it isn't checked again
+        self._store_exists = os.path.isdir(path)
+        self._migrate_legacy_store()
+
+        # Records not yet written to the store; flushes are serialized so a
+        # read that flushes first sees every record
+        # Records are tuples in USAGE_SCHEMA column order, turned into columns on flush
+        self._pending: List[tuple] = []
+        self._pending_lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._flush_task: Optional[asyncio.Task] = None
+
+        # (expiry, models index) from the last scan of the models in the store
+        self._models_cache: Optional[
+            Tuple[float, Tuple[List[str], List[str], Dict[str, str]]]
+        ] = None
+
+        # Recent usage per model, plus all models under None, answering queries
+        # without reading the store. Records are read by the statistics thread.
+        self._windows: Dict[Optional[str], UsageWindow] = {}
+        self._windows_lock = threading.Lock()
+        # The in-memory windows hold every record from this time on
+        self._windows_complete_since = datetime.max
+        self._load_recent_usage()
+
+    def _migrate_legacy_store(self):
+        """Copy usage recorded in PyStore by earlier versions into the parquet dataset.
+
+        PyStore kept the records as Dask-written parquet parts with the timestamp
+        as the pandas index, so they are read directly without PyStore or Dask.
+        """
+        legacy_item = os.path.join(
+            PYSTORE_PATH, "token_metrics", "usage", "token_usage"
+        )
+        if self._store_exists or not os.path.isdir(legacy_item):
+            return
         try:
-            if self._item_exists("token_usage"):
-                # Manual append: read existing, concatenate, and write back
-                existing_data = self.collection.item("token_usage").data.compute()
-                logger.debug(f"Before append: {len(existing_data)} existing records")
-
-                # Concatenate existing and new data
-                combined_data = pd.concat([existing_data, new_data])
-
-                # Write back the combined data (overwrites existing)
-                self.collection.write("token_usage", combined_data, overwrite=True)
-                logger.debug(f"Manual append completed")
-            else:
-                # Create new item
-                self.collection.write("token_usage", new_data)
-                logger.debug(f"Created new token usage data item")
-
-            # Verify the record was added
-            verification_data = self.collection.item("token_usage").data.compute()
-            logger.debug(f"After operation: now have {len(verification_data)} records")
-
-            logger.info(
-                f"Recorded token usage for {model}: {input_tokens} input, {output_tokens} output"
+            parts = sorted(glob.glob(os.path.join(legacy_item, "*.parquet")))
+            if not parts:
+                return
+            data = ds.dataset(parts, format="parquet").to_table()
+            # The timestamp index is stored as a column named in the pandas metadata
+            index_column = next(
+                column
+                for column in data.schema.pandas_metadata["index_columns"]
+                if isinstance(column, str)
+            )
+            self._write(
+                _usage_table(
+                    {
+                        "timestamp": data[index_column].cast(pa.timestamp("us")),
+                        "record_id": data["record_id"],
+                        "model": data["model"],
+                        "input_tokens": data["input_tokens"],
+                        "output_tokens": data["output_tokens"],
+                        "total_tokens": data["total_tokens"],
+                    }
+                )
+            )
+            logger.info(f"Migrated {data.num_rows} token usage records from PyStore")
+        except Exception as e:
+            logger.error(f"Failed to migrate token usage from PyStore: {e}")
+
+    def _write(self, table: pa.Table):
+        """Append usage records to the dataset as new files."""
+        pq.write_to_dataset(table, root_path=self.path, partition_cols=["date"])
+        self._store_exists = True
+
+    def flush(self):
+        """Write pending usage records to the store as one batch."""
+        with self._flush_lock:
+            with self._pending_lock:
+                rows, self._pending = self._pending, []
+            if not rows:
+                return
+            try:
+                self._write(_usage_table(dict(zip(USAGE_SCHEMA.names, zip(*rows)))))
+                logger.debug(f"Flushed {len(rows)} token usage records")
+            except Exception as e:
+                logger.error(f"Failed to write token usage: {e}")
+                # Keep the records for the next flush
+                with self._pending_lock:
+                    self._pending[:0] = rows
+
+    def start_flusher(self):
+        """Start writing recorded usage in the background, on the running event loop."""
+        if self._flush_task is None:
+            self._flush_task = asyncio.create_task(self._flush_periodically())
+
+    async def _flush_periodically(self):
+        while True:
+            await asyncio.sleep(FLUSH_INTERVAL_SECONDS)
+            if self._pending:
+                await asyncio.to_thread(self.flush)
+
+    async def close(self):
+        """Stop the background flusher and write any pending usage."""
+        if self._flush_task is not None:
+            self._flush_task.cancel()
+            self._flush_task = None
+        await asyncio.to_thread(self.flush)
+
+    def _read_usage(
+        self,
+        start_time: Optional[datetime] = None,
+        end_time: Optional[datetime] = None,
+        model: Optional[str] = None,
+        columns: Optional[List[str]] = None,
+    ) -> pd.DataFrame:
+        """
+        Read usage records indexed by timestamp, optionally within [start_time, end_time]
+        and for one model.
+        """
+        return (
+            self._scan(start_time, end_time, model, columns)
+            .to_pandas()
+            .set_index("timestamp")
+        )
+
+    def _scan(
+        self,
+        start_time: Optional[datetime] = None,
+        end_time: Optional[datetime] = None,
+        model: Optional[str] = None,
+        columns: Optional[List[str]] = None,
+    ) -> pa.Table:
+        """
+        Read usage records with their timestamps, optionally within [start_time, end_time]
+        and for one model.
+
+        The conditions are pushed down into the dataset scan, so only matching
+        days and rows are read.
+        """
+        if columns is not None:
+            columns = ["timestamp", *columns]
+
+        # Pending records are written first so the store is complete
+        self.flush()
+        if not self._has_data():
+            table = USAGE_DATASET_SCHEMA.empty_table()
+            return table.select(columns) if columns is not None else table
+
+        conditions = []
+        if start_time is not None:
+            conditions.append(pc.field("date") >= start_time.date().isoformat())
+            conditions.append(
+                pc.field("timestamp") >= pa.scalar(start_time, pa.timestamp("us"))
             )
+        if end_time is not None:
+            conditions.append(pc.field("date") <= end_time.date().isoformat())
+            conditions.append(
+                pc.field("timestamp") <= pa.scalar(end_time, pa.timestamp("us"))
+            )
+        if model:
+            conditions.append(pc.field("model") == model)
+        condition = reduce(operator.and_, conditions) if conditions else None
+
+        dataset = ds.dataset(
+            self.path,
+            schema=USAGE_DATASET_SCHEMA,
+            format="parquet",
+            partitioning=USAGE_PARTITIONING,
+        )
+        return dataset.to_table(columns=columns, filter=condition)
+
+    def _load_recent_usage(self):
+        """Seed the in-memory usage windows from the store."""
+        since = datetime.now() - USAGE_WINDOW_RETENTION
+        try:
+            if self._has_data():
+                recent = self._read_usage(since).sort_index()
+                for timestamp, model, input_tokens, output_tokens in zip(
+                    recent.index,
+                    recent["model"],
+                    recent["input_tokens"],
+                    recent["output_tokens"],
+                ):
+                    self._add_to_windows(
+                        timestamp.to_pydatetime(),
+                        model,
+                        int(input_tokens),
+                        int(output_tokens),
+                    )
+            self._windows_complete_since = since
         except Exception as e:
-            logger.error(f"Failed to record token usage: {e}")
+            # Queries fall back to reading the store
+            logger.error(f"Failed to load recent token usage: {e}")
+
+    def _add_to_windows(
+        self, timestamp: datetime, model: str, input_tokens: int, output_tokens: int
+    ):
+        with self._windows_lock:
+            for key in (model, None):
+                window = self._windows.get(key)
+                if window is None:
+                    window = self._windows[key] = UsageWindow()
+                window.add(timestamp, input_tokens, output_tokens)
+
+    def _evict_old_usage(self, now: datetime):
+        cutoff = now - USAGE_WINDOW_RETENTION
+        with self._windows_lock:
+            for window in self._windows.values():
+                window.evict_before(cutoff)
+            self._windows_complete_since = max(self._windows_complete_since, cutoff)
+
+    def _has_data(self) -> bool:
+        """Check if any usage has been recorded."""
+        return self._store_exists or bool(self._pending)
+
+    def record_usage(
+        self,
+        model: str,
+        input_tokens: int,
+        output_tokens: int,
+        timestamp: Optional[datetime] = None,
+    ):
+        """Record token usage for a specific model, at timestamp or now."""
+        if timestamp is None:
+            timestamp = datetime.now()
+        record_id = str(uuid.uuid4())  # Generate unique ID for this record
 
-    def record_usage_from_response(self, model: str, usage_data: Dict[str, int]):
+        # Queue the record to be written with others, rather than writing a file per record
+        with self._pending_lock:
+            self._pending.append(
+                (
+                    timestamp,
+                    record_id,
+                    model,
+                    input_tokens,
+                    output_tokens,
+                    input_tokens + output_tokens,
+                )
+            )
+            flush_now = len(self._pending) >= FLUSH_MAX_RECORDS
+        logger.info(
+            f"Recorded token usage for {model}: {input_tokens} input, {output_tokens} output"
+        )
+
+        self._add_to_windows(timestamp, model, input_tokens, output_tokens)
+        self._evict_old_usage(timestamp)
+        # A model seen for the first time isn't in the cached list yet
+        cached = self._models_cache
+        if cached is not None and model not in cached[1][0]:
+            self._models_cache = None
+        if flush_now:
+            self.flush()
+
+    def record_usage_from_response(
+        self,
+        model: str,
+        usage_data: Dict[str, int],
+        timestamp: Optional[datetime] = None,
+    ):
         """Record token usage from API response usage stats."""
         input_tokens = usage_data.get("prompt_tokens", 0)
         output_tokens = usage_data.get("completion_tokens", 0)
         logger.info(
             f"Recording usage from API response: {input_tokens} input, {output_tokens} output tokens for {model}"
         )
-        self.record_usage(model, input_tokens, output_tokens)
+        self.record_usage(model, input_tokens, output_tokens, timestamp)
 
     def query_usage(
         self, start_time: datetime, end_time: datetime, model: Optional[str] = None
     ) -> dict:
         """Query token usage within a time range."""
+        result = self.query_usage_multi([start_time], end_time, model)[0]
+        logger.debug(
+            f"Token usage for {model if model else 'all models'} from {start_time} to {end_time}: {result['total_tokens']} total tokens ({result['total_input_tokens']} input, {result['total_output_tokens']} output)"
+        )
+        return result
+
+    def query_usage_multi(
+        self,
+        start_times: List[datetime],
+        end_time: datetime,
+        model: Optional[str] = None,
+    ) -> List[dict]:
+        """
+        Query token usage for several windows sharing the same end time.
+
+        Reads the records for the widest window once and aggregates each
+        narrower window from that result, instead of querying once per window.
+        """
+        empty = {"total_input_tokens": 0, "total_output_tokens": 0, "total_tokens": 0}
+        if not start_times:
+            return []
+
+        # Recent windows are answered from memory
+        with self._windows_lock:
+            if min(start_times) >= self._windows_complete_since:
+                window = self._windows.get(model or None)
+                results = []
+                for start_time in start_times:
+                    input_tokens, output_tokens, total_tokens, record_count = (
+                        window.totals(start_time, end_time) if window else (0, 0, 0, 0)
+                    )
+                    result = {
+                        "total_input_tokens": input_tokens,
+                        "total_output_tokens": output_tokens,
+                        "total_tokens": total_tokens,
+                        "record_count": record_count,
+                    }
+                    if model:
+                        result["model"] = model  # type: ignore
+                    results.append(result)
+                return results
+
         try:
-            # Check if token_usage item exists
-            if not self._item_exists("token_usage"):
+            if not self._has_data():
                 logger.warning("No token usage data available yet")
-                return {
-                    "total_input_tokens": 0,
-                    "total_output_tokens": 0,
-                    "total_tokens": 0,
+                return [dict(empty) for _ in start_times]
+
+            # Read the rows of the widest window in one scan, then total each
+            # window's columns in a single Arrow aggregation
+            widest = self._scan(
+                min(start_times), end_time, model, columns=list(TOKEN_COLUMNS)
+            ).combine_chunks()
+            aggregations = [(column, "sum") for column in TOKEN_COLUMNS]
+            aggregations.append(([], "count_all"))
+
+            results = []
+            for start_time in start_times:
+                window = widest.filter(
+                    pc.field("timestamp") >= pa.scalar(start_time, pa.timestamp("us"))
+                )
+                totals = window.group_by([]).aggregate(aggregations).to_pylist()[0]
+                result = {
+                    "total_input_tokens": totals["input_tokens_sum"] or 0,
+                    "total_output_tokens": totals["output_tokens_sum"] or 0,
+                    "total_tokens": totals["total_tokens_sum"] or 0,
+                    "record_count": totals["count_all"],
                 }
-
-            # Get all data and log what we found
-            data = self.collection.item("token_usage").data
-            logger.debug(f"Total records in store during query: {len(data)}")
-
-            # Try showing all records
-            # computed_data = data.compute()
-            # for idx, row in computed_data.iterrows():
-            #     logger.debug(f"Record: {idx}, model: {row['model']}, tokens: {row['total_tokens']}")
-
-            # Filter by time range
-            mask = (data.index >= start_time) & (data.index <= end_time)
-            if model:
-                mask &= data["model"] == model
-
-            filtered_data = data[mask]
-
-            # Print debug info
-            record_count = len(filtered_data)
-            logger.debug(
-                f"Found {record_count} records in the time range {start_time} to {end_time}"
-            )
-
-            # Calculate totals and compute the actual values
-            result = {
-                "total_input_tokens": int(
-                    filtered_data["input_tokens"].sum().compute()
-                ),
-                "total_output_tokens": int(
-                    filtered_data["output_tokens"].sum().compute()
-                ),
-                "total_tokens": int(filtered_data["total_tokens"].sum().compute()),
-                "record_count": record_count,
-            }
-
-            if model:
-                result["model"] = model  # type: ignore
+                if model:
+                    result["model"] = model  # type: ignore
+                results.append(result)
 
             logger.debug(
-                f"Token usage for {model if model else 'all models'}: {result['total_tokens']} total tokens ({result['total_input_tokens']} input, {result['total_output_tokens']} output)"
+                f"Queried {len(start_times)} windows for {model if model else 'all models'} from {widest.num_rows} records"
             )
-            return result
+            return results
         except Exception as e:
             logger.error(f"Failed to query token usage: {e}")
-            return {
-                "total_input_tokens": 0,
-                "total_output_tokens": 0,
-                "total_tokens": 0,
-            }
+            return [dict(empty) for _ in start_times]
 
     def debug_show_all_records(self):
         """Debug method to show all stored records."""
-        if not self._item_exists("token_usage"):
+        if not self._has_data():
             logger.debug("No token usage data exists yet")
             return None
 
-        data = self.collection.item("token_usage").data
-        logger.debug(f"Total records in store: {len(data)}")
-
-        # Safely handle the Dask DataFrame
         try:
-            # Compute the data to get a pandas DataFrame
-            computed_data = data.compute()
-            logger.debug(f"Records by timestamp: {computed_data.index.tolist()}")
-            return computed_data
-        except Exception as e:
-            logger.error(f"Failed to display timestamps: {e}")
-            logger.debug(f"First few records (head): {data.head()}")
+            data = self._read_usage()
+            logger.debug(f"Total records in store: {len(data)}")
+            logger.debug(f"Records by timestamp: {data.index.tolist()}")
             return data
+        except Exception as e:
+            logger.error(f"Failed to read token usage records: {e}")
+            return None
 
     def get_available_models(self) -> List[str]:
         """Get a list of all models that have usage data."""
+        return list(self._model_index()[0])
+
+    def _model_index(self) -> Tuple[List[str], List[str], Dict[str, str]]:
+        """
+        Return the models with usage data, their lowercased names, and the first
+        model for each leading name part (e.g. 'gpt' for 'gpt-4-turbo').
+
+        Built from one scan of the store and reused for AVAILABLE_MODELS_TTL_SECONDS.
+        """
+        now = time.monotonic()
+        cached = self._models_cache
+        if cached is not None and now < cached[0]:
+            return cached[1]
+
         try:
-            if not self._item_exists("token_usage"):
+            if not self._has_data():
                 logger.warning("No token usage data available yet")
-                return []
+                return [], [], {}
 
-            data = self.collection.item("token_usage").data
-            unique_models = data["model"].unique().compute().tolist()
+            models = self._scan(columns=["model"])["model"]
+            unique_models = pc.unique(models).to_pylist()
             logger.debug(f"Found {len(unique_models)} unique models in the database")
-            return unique_models
         except Exception as e:
             logger.error(f"Failed to get available models: {e}")
-            return []
+            return [], [], {}
+
+        by_first_part: Dict[str, str] = {}
+        for available_model in unique_models:
+            by_first_part.setdefault(available_model.split("-")[0], available_model)
+        index = (unique_models, [m.lower() for m in unique_models], by_first_part)
+        self._models_cache = (now + AVAILABLE_MODELS_TTL_SECONDS, index)
+        return index
 
     def find_similar_model(self, model_name: str) -> Optional[str]:
         """Find a similar model name in the database using simple string matching."""
-        available_models = self.get_available_models()
+        available_models, lowered_models, by_first_part = self._model_index()
         if not available_models:
             return None
 
         # Check if any model contains the given name or vice versa
         model_name_lower = model_name.lower()
-        for available_model in available_models:
+        for available_model, available_lower in zip(available_models, lowered_models):
             if (
-                model_name_lower in available_model.lower()
-                or available_model.lower() in model_name_lower
+                model_name_lower in available_lower
+                or available_lower in model_name_lower
             ):
                 return available_model
 
-        # Check for common typos or partial matches
-        for available_model in available_models:
-            # Compare first parts of model names (e.g., 'gpt-4' vs 'gpt-4-turbo')
-            parts1 = model_name.split("-")
-            parts2 = available_model.split("-")
-
-            if len(parts1) > 0 and len(parts2) > 0 and parts1[0] == parts2[0]:
-                return available_model
-
-        return None
+        # Check for common typos or partial matches, comparing first parts of
+        # model names (e.g., 'gpt-4' vs 'gpt-4-turbo')
+        return by_first_part.get(model_name.split("-")[0])
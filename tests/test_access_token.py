@@ -0,0 +1,47 @@
+import asyncio
+import os
+from unittest import mock
+
+import pytest
+
+# The module reads settings on import
+with mock.patch.dict(os.environ, {"REFRESH_TOKEN": "gho_test_token_for_import"}):
+    from copilot_more import access_token
+
+
+@pytest.mark.asyncio
+async def test_cancelled_caller_does_not_cancel_shared_refresh() -> None:
+    refreshes = 0
+
+    async def refresh_and_cache(index: int) -> dict:
+        nonlocal refreshes
+        refreshes += 1
+        await asyncio.sleep(0.05)
+        return {"token": "refreshed", "expires_at": 2**40}
+
+    with mock.patch.object(access_token, "_refresh_and_cache", refresh_and_cache):
+        leader = asyncio.create_task(access_token.get_cached_copilot_token())
+        waiter = asyncio.create_task(access_token.get_cached_copilot_token())
+        await asyncio.sleep(0)
+        # The first caller goes away while the refresh is in flight
+        leader.cancel()
+
+        assert (await asyncio.wait_for(waiter, timeout=5))["token"] == "refreshed"
+        with pytest.raises(asyncio.CancelledError):
+            await leader
+    assert refreshes == 1
+    assert not access_token.INFLIGHT
+
+
+def test_refresh_is_never_scheduled_in_the_past() -> None:
+    store = access_token.TokenStore()
+    now = 1_000_000.0
+
+    store.set(0, {"token": "no-expiry"}, now)
+    assert store.next_refresh() == (None, float("inf"))
+
+    store.set(1, {"token": "expired", "expires_at": now - 60}, now)
+    assert store.next_refresh() == (1, now + access_token.REFRESHER_RETRY_SECONDS)
+
+    store.set(1, {"token": "fresh", "expires_at": now + 1800}, now)
+    assert store.next_refresh() == (1, now + 900)
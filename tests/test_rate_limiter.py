@@ -1,17 +1,24 @@
-from datetime import datetime, timedelta
+import asyncio
+import time
+from datetime import datetime
 from unittest.mock import Mock
 
 import pytest
 
 from copilot_more.rate_limit_types import (MAX_DELAY_SECONDS,
                                            RateLimitBehavior, RateLimitRule)
-from copilot_more.rate_limiter import RateLimiter, RateLimitError
+from copilot_more.rate_limiter import RateLimiter, RateLimitError, TokenBucket
 from copilot_more.token_counter import TokenUsage
 
 
 @pytest.fixture
 def token_usage():
-    return Mock(spec=TokenUsage)
+    usage = Mock(spec=TokenUsage)
+    # Answer batched window queries with whatever query_usage is set to return
+    usage.query_usage_multi.side_effect = lambda start_times, end_time, model=None: [
+        usage.query_usage(start_time, end_time, model) for start_time in start_times
+    ]
+    return usage
 
 
 @pytest.fixture
@@ -29,28 +36,31 @@ def base_time():
     return datetime(2025, 1, 1, 12, 0, 0)  # Noon on Jan 1st, 2025
 
 
+@pytest.fixture
+def base_monotonic():
+    return 1000.0  # Arbitrary time.monotonic() reading
+
+
 @pytest.mark.asyncio
-async def test_sliding_window_request_limits(rate_limiter, test_model, base_time):
+async def test_sliding_window_request_limits(rate_limiter, test_model, base_monotonic):
     """Test sliding window behavior for request rate limiting."""
     # Create a rule: max 3 requests per 5 minutes
     rule = RateLimitRule(window_minutes=5, requests=3, behavior=RateLimitBehavior.ERROR)
     rate_limiter.add_rule(test_model, rule)
 
     # Make 3 requests at different times within the window
-    current_time = base_time
+    current_time = base_monotonic
     rate_limiter.record_request(test_model, current_time)
-    rate_limiter.record_request(test_model, current_time + timedelta(minutes=1))
-    rate_limiter.record_request(test_model, current_time + timedelta(minutes=2))
+    rate_limiter.record_request(test_model, current_time + 60)
+    rate_limiter.record_request(test_model, current_time + 120)
 
     # Fourth request should fail
     with pytest.raises(RateLimitError):
-        await rate_limiter.check_request_limit(
-            test_model, current_time + timedelta(minutes=3)
-        )
+        await rate_limiter.check_request_limit(test_model, current_time + 180)
 
     # After 6 minutes from the first request, the earliest request should be out of the window
     # allowing a new request
-    new_time = current_time + timedelta(minutes=6)
+    new_time = current_time + 360
     result = await rate_limiter.check_request_limit(test_model, new_time)
     assert result is None
 
@@ -91,28 +101,45 @@ async def test_sliding_window_token_limits(
 
 
 @pytest.mark.asyncio
-async def test_delay_behavior(rate_limiter, test_model, base_time):
+async def test_delay_behavior(rate_limiter, test_model, base_monotonic):
     """Test delay behavior for rate limiting."""
     # Create a rule with DELAY behavior
     rule = RateLimitRule(window_minutes=5, requests=2, behavior=RateLimitBehavior.DELAY)
     rate_limiter.add_rule(test_model, rule)
 
-    current_time = base_time
+    current_time = base_monotonic
 
     # Make initial requests
     rate_limiter.record_request(test_model, current_time)
-    rate_limiter.record_request(test_model, current_time + timedelta(minutes=1))
+    rate_limiter.record_request(test_model, current_time + 60)
 
     # Third request should require delay
-    delay = await rate_limiter.check_request_limit(
-        test_model, current_time + timedelta(minutes=2)
-    )
+    delay = await rate_limiter.check_request_limit(test_model, current_time + 120)
     assert delay is not None
     assert delay > 0
 
 
 @pytest.mark.asyncio
-async def test_combined_limits(rate_limiter, test_model, base_time, token_usage):
+async def test_delay_until_oldest_request_leaves_window(
+    rate_limiter, test_model, base_monotonic
+):
+    """Test that the delay lasts until the oldest counted request leaves the window."""
+    rule = RateLimitRule(window_minutes=5, requests=2, behavior=RateLimitBehavior.DELAY)
+    rate_limiter.add_rule(test_model, rule)
+
+    rate_limiter.record_request(test_model, base_monotonic)
+    rate_limiter.record_request(test_model, base_monotonic + 60)
+    rate_limiter.record_request(test_model, base_monotonic + 90)
+
+    # The request at +60 is the oldest of the last two and expires at +360
+    delay = await rate_limiter.check_request_limit(test_model, base_monotonic + 120)
+    assert delay == pytest.approx(240)
+
+
+@pytest.mark.asyncio
+async def test_combined_limits(
+    rate_limiter, test_model, base_time, base_monotonic, token_usage
+):
     """Test combined token and request rate limiting."""
     # Create rules for both tokens and requests
     token_rule = RateLimitRule(
@@ -124,7 +151,7 @@ async def test_combined_limits(rate_limiter, test_model, base_time, token_usage)
     rate_limiter.add_rule(test_model, token_rule)
     rate_limiter.add_rule(test_model, request_rule)
 
-    current_time = base_time
+    current_time = base_monotonic
 
     # Mock token usage below limit
     token_usage.query_usage.return_value = {
@@ -135,12 +162,12 @@ async def test_combined_limits(rate_limiter, test_model, base_time, token_usage)
 
     # Make requests up to the request limit
     rate_limiter.record_request(test_model, current_time)
-    rate_limiter.record_request(test_model, current_time + timedelta(minutes=1))
-    rate_limiter.record_request(test_model, current_time + timedelta(minutes=2))
+    rate_limiter.record_request(test_model, current_time + 60)
+    rate_limiter.record_request(test_model, current_time + 120)
 
     # Should fail on request limit even though token limit is fine
     with pytest.raises(RateLimitError):
-        next_time = current_time + timedelta(minutes=3)
+        next_time = current_time + 180
         # Check limit first - should fail since we already have 3 requests
         await rate_limiter.check_request_limit(test_model, next_time)
         # This line shouldn't be reached since check_request_limit should raise
@@ -155,7 +182,7 @@ async def test_combined_limits(rate_limiter, test_model, base_time, token_usage)
 
     # Should fail on token limit
     with pytest.raises(RateLimitError):
-        rate_limiter.check_token_limits(test_model, current_time)
+        rate_limiter.check_token_limits(test_model, base_time)
 
 
 def test_token_delay_cap(rate_limiter, test_model, base_time, token_usage):
@@ -182,3 +209,73 @@ def test_token_delay_cap(rate_limiter, test_model, base_time, token_usage):
 
     assert delay is not None
     assert delay <= MAX_DELAY_SECONDS
+
+
+@pytest.mark.asyncio
+async def test_acquire_waits_until_notified(rate_limiter, test_model):
+    """Test that acquire re-checks limits when waiters are notified."""
+    rule = RateLimitRule(window_minutes=5, requests=1, behavior=RateLimitBehavior.DELAY)
+    rate_limiter.add_rule(test_model, rule)
+    rate_limiter.record_request(test_model, time.monotonic())
+
+    waiter = asyncio.create_task(rate_limiter.acquire(test_model))
+    await asyncio.sleep(0.01)
+    assert not waiter.done()
+
+    # Free the window and wake the waiter instead of letting it sleep ~5 minutes
+    rate_limiter.request_counters.clear()
+    await rate_limiter.notify_waiters()
+    await asyncio.wait_for(waiter, timeout=1)
+
+
+@pytest.mark.asyncio
+async def test_acquire_raises_for_error_behavior(rate_limiter, test_model):
+    """Test that acquire raises instead of waiting for ERROR rules."""
+    rule = RateLimitRule(window_minutes=5, requests=1, behavior=RateLimitBehavior.ERROR)
+    rate_limiter.add_rule(test_model, rule)
+    rate_limiter.record_request(test_model, time.monotonic())
+
+    with pytest.raises(RateLimitError):
+        await rate_limiter.acquire(test_model)
+
+
+@pytest.mark.asyncio
+async def test_token_error_limit_blocks_later_requests(
+    rate_limiter, test_model, base_time, token_usage
+):
+    """Test that exceeding a token limit with ERROR behavior rejects later requests."""
+    rule = RateLimitRule(
+        window_minutes=1, total_tokens=1000, behavior=RateLimitBehavior.ERROR
+    )
+    rate_limiter.add_rule(test_model, rule)
+    token_usage.query_usage.return_value = {
+        "total_input_tokens": 1000,
+        "total_output_tokens": 500,
+        "total_tokens": 1500,  # 150% of limit, so blocked for half the window
+    }
+
+    with pytest.raises(RateLimitError):
+        rate_limiter.check_token_limits(test_model, base_time)
+
+    now = time.monotonic()
+    with pytest.raises(RateLimitError, match="Token rate limit exceeded"):
+        await rate_limiter.acquire(test_model)
+    # Other models are unaffected
+    assert await rate_limiter.check_request_limit("other-model", now) is None
+
+    # Requests are accepted again once the block has passed
+    assert await rate_limiter.check_request_limit(test_model, now + 31) is None
+
+
+@pytest.mark.asyncio
+async def test_token_bucket_caps_request_rate():
+    """Test that the token bucket allows a burst, then spaces requests by its rate."""
+    bucket = TokenBucket(rate=5.0, capacity=2)
+
+    start = time.monotonic()
+    await bucket.acquire()
+    await bucket.acquire()
+    assert time.monotonic() - start < 0.15  # Burst within capacity, no 0.2s wait
+
+    await asyncio.gather(bucket.acquire(), bucket.acquire())
+    assert time.monotonic() - start >= 0.39  # Two more at 5/s take ~0.4s
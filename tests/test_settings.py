@@ -5,179 +5,222 @@ Tests for the settings module.
 import json
 import os
 from pathlib import Path
-from unittest import TestCase, mock
+from typing import Optional
 
 import pytest
 from pydantic import ValidationError
 
-# Ensure we don't trigger the validation when importing for tests
-with mock.patch.dict(os.environ, {"REFRESH_TOKEN": "gho_test_token_for_import"}):
-    from copilot_more.settings import Settings
-
 from copilot_more.rate_limit_types import RateLimitBehavior
-
-
-class TestSettings(TestCase):
-    """Tests for the Settings class."""
-
-    def setUp(self):
-        # Clear any environment variables that might affect tests
-        os.environ.pop("REFRESH_TOKEN", None)
-        os.environ.pop("CHAT_COMPLETIONS_API_ENDPOINT", None)
-        os.environ.pop("MODELS_API_ENDPOINT", None)
-        os.environ.pop("EDITOR_VERSION", None)
-        os.environ.pop("MAX_TOKENS", None)
-        os.environ.pop("TIMEOUT_SECONDS", None)
-        os.environ.pop("RECORD_TRAFFIC", None)
-
-    def test_refresh_token_validation(self):
-        """Test that refresh token is validated."""
-        # Must start with gho_
-        with mock.patch.dict(os.environ, {"REFRESH_TOKEN": "invalid_token"}):
-            with pytest.raises(ValidationError) as excinfo:
-                Settings()
-            assert (
-                "REFRESH_TOKEN should be a GitHub OAuth token starting with 'gho_'"
-                in str(excinfo.value)
-            )
-
-        # Valid token
-        with mock.patch.dict(os.environ, {"REFRESH_TOKEN": "gho_valid_token"}):
-            settings = Settings()
-            assert settings.refresh_token == "gho_valid_token"
-
-    def test_default_values(self):
-        """Test that default values are set correctly."""
-        with mock.patch.dict(os.environ, {"REFRESH_TOKEN": "gho_valid_token"}):
-            settings = Settings()
-            assert (
-                settings.chat_completions_api_endpoint
-                == "https://api.individual.githubcopilot.com/chat/completions"
-            )
-            assert (
-                settings.models_api_endpoint
-                == "https://api.individual.githubcopilot.com/models"
-            )
-            assert settings.editor_version == "vscode/1.97.2"
-            assert settings.max_tokens == 10240
-            assert settings.timeout_seconds == 300
-            assert settings.record_traffic is False
-
-    def test_custom_values(self):
-        """Test that custom values can be set."""
-        with mock.patch.dict(
-            os.environ,
+from copilot_more.settings import RateLimitSettings, Settings
+
+
+# Environment variables read by the tests below
+SETTINGS_ENV_VARS = frozenset(
+    {
+        "REFRESH_TOKEN",
+        "CHAT_COMPLETIONS_API_ENDPOINT",
+        "MODELS_API_ENDPOINT",
+        "EDITOR_VERSION",
+        "MAX_TOKENS",
+        "TIMEOUT_SECONDS",
+        "RECORD_TRAFFIC",
+        "RATE_LIMITS_FILE",
+    }
+)
+
+VALID_LIMITS_JSON = json.dumps(
+    {
+        "test-model": [
             {
-                "REFRESH_TOKEN": "gho_valid_token",
-                "CHAT_COMPLETIONS_API_ENDPOINT": "https://custom.endpoint/chat",
-                "MODELS_API_ENDPOINT": "https://custom.endpoint/models",
-                "EDITOR_VERSION": "custom-editor/1.0",
-                "MAX_TOKENS": "5000",
-                "TIMEOUT_SECONDS": "600",
-                "RECORD_TRAFFIC": "true",
-            },
-        ):
-            settings = Settings()
-            assert (
-                settings.chat_completions_api_endpoint == "https://custom.endpoint/chat"
-            )
-            assert settings.models_api_endpoint == "https://custom.endpoint/models"
-            assert settings.editor_version == "custom-editor/1.0"
-            assert settings.max_tokens == 5000
-            assert settings.timeout_seconds == 600
-            assert settings.record_traffic is True
-
-    def test_boolean_conversion(self):
-        """Test that boolean values are converted correctly."""
-        test_cases = [
-            ("true", True),
-            ("True", True),
-            ("TRUE", True),
-            ("1", True),
-            ("yes", True),
-            ("false", False),
-            ("False", False),
-            ("FALSE", False),
-            ("0", False),
-            ("no", False),
+                "window_minutes": 1,
+                "total_tokens": 1000,
+                "input_tokens": 500,
+                "output_tokens": 500,
+                "requests": 5,
+                "behavior": "delay",
+            }
         ]
-
-        for value, expected in test_cases:
-            with mock.patch.dict(
-                os.environ,
-                {"REFRESH_TOKEN": "gho_valid_token", "RECORD_TRAFFIC": value},
-            ):
-                settings = Settings()
-                assert settings.record_traffic is expected, f"Failed for value: {value}"
-
-    def test_rate_limits_loading(self):
-        """Test loading of rate limits from JSON file."""
-        test_limits = {
-            "test-model": [
-                {
-                    "window_minutes": 1,
-                    "total_tokens": 1000,
-                    "input_tokens": 500,
-                    "output_tokens": 500,
-                    "requests": 5,
-                    "behavior": "delay",
-                }
-            ]
-        }
-
-        # Mock everything needed for rate limits loading
-        mock_open = mock.mock_open(read_data=json.dumps(test_limits))
-        with mock.patch.dict(os.environ, {"REFRESH_TOKEN": "gho_valid_token"}):
-            with mock.patch("builtins.open", mock_open):
-                with mock.patch("os.path.exists") as mock_exists:
-                    mock_exists.return_value = True
-                    settings = Settings()
-
-                    # Verify rate limits loaded correctly
-                    assert "test-model" in settings.rate_limits
-                    limits = settings.rate_limits["test-model"]
-                    assert len(limits) == 1
-                    limit = limits[0]
-                    assert limit.window_minutes == 1
-                    assert limit.total_tokens == 1000
-                    assert limit.input_tokens == 500
-                    assert limit.output_tokens == 500
-                    assert limit.requests == 5
-                    assert limit.behavior == RateLimitBehavior.DELAY
-
-    def test_rate_limits_file_not_found(self):
-        """Test behavior when rate limits file is not found."""
-        with mock.patch.dict(os.environ, {"REFRESH_TOKEN": "gho_valid_token"}):
-            with mock.patch("os.path.exists") as mock_exists:
-                mock_exists.return_value = False
-                settings = Settings()
-                assert settings.rate_limits == {}
-
-    def test_rate_limits_invalid_json(self):
-        """Test behavior with invalid JSON in rate limits file."""
-        mock_open = mock.mock_open(read_data="invalid json")
-        with mock.patch.dict(os.environ, {"REFRESH_TOKEN": "gho_valid_token"}):
-            with mock.patch("builtins.open", mock_open):
-                with mock.patch("os.path.exists") as mock_exists:
-                    mock_exists.return_value = True
-                    settings = Settings()
-                    assert settings.rate_limits == {}
-
-    def test_rate_limits_invalid_schema(self):
-        """Test validation of rate limits schema."""
-        invalid_limits = {
-            "test-model": [
-                {
-                    "window_minutes": -1,  # Invalid: must be positive
-                    "behavior": "invalid",  # Invalid: must be delay or error
-                }
-            ]
-        }
-
-        mock_open = mock.mock_open(read_data=json.dumps(invalid_limits))
-        with mock.patch.dict(os.environ, {"REFRESH_TOKEN": "gho_valid_token"}):
-            with mock.patch("builtins.open", mock_open):
-                with mock.patch("os.path.exists") as mock_exists:
-                    mock_exists.return_value = True
-                    settings = Settings()
-                    assert settings.rate_limits == {}
+    }
+)
+INVALID_LIMITS_JSON = json.dumps(
+    {
+        "test-model": [
+            {
+                "window_minutes": -1,  # Invalid: must be positive
+                "behavior": "invalid",  # Invalid: must be delay or error
+            }
+        ]
+    }
+)
+
+
+def clear_settings_vars(monkeypatch: pytest.MonkeyPatch):
+    """Remove the variables read by the tests, restoring them when monkeypatch is undone"""
+    for var in SETTINGS_ENV_VARS.intersection(os.environ):
+        monkeypatch.delenv(var)
+
+
+@pytest.fixture(autouse=True)
+def clear_settings_env(monkeypatch):
+    # Clear any environment variables that might affect tests
+    clear_settings_vars(monkeypatch)
+
+
+@pytest.fixture
+def rate_limits_file(tmp_path: Path, monkeypatch) -> Path:
+    """Where Settings reads rate limits from; the file is not created"""
+    path = tmp_path / "rate_limits.json"
+    monkeypatch.setenv("RATE_LIMITS_FILE", str(path))
+    monkeypatch.setenv("REFRESH_TOKEN", "gho_valid_token")
+    return path
+
+
+def settings_from_env(env: dict, rate_limits_path: Path) -> Settings:
+    """Build Settings from exactly the given variables and rate limits path."""
+    with pytest.MonkeyPatch.context() as monkeypatch:
+        clear_settings_vars(monkeypatch)
+        for var, value in env.items():
+            monkeypatch.setenv(var, value)
+        monkeypatch.setenv("RATE_LIMITS_FILE", str(rate_limits_path))
+        return Settings()
+
+
+@pytest.fixture(scope="module")
+def custom_settings(tmp_path_factory) -> Settings:
+    """Settings with every tested variable set, shared by the tests that read it"""
+    return settings_from_env(
+        {
+            "REFRESH_TOKEN": "gho_valid_token",
+            "CHAT_COMPLETIONS_API_ENDPOINT": "https://custom.endpoint/chat",
+            "MODELS_API_ENDPOINT": "https://custom.endpoint/models",
+            "EDITOR_VERSION": "custom-editor/1.0",
+            "MAX_TOKENS": "5000",
+            "TIMEOUT_SECONDS": "600",
+            "RECORD_TRAFFIC": "true",
+        },
+        tmp_path_factory.mktemp("custom") / "rate_limits.json",
+    )
+
+
+def test_refresh_token_validation(monkeypatch):
+    """Test that refresh token is validated."""
+    # Must start with gho_
+    monkeypatch.setenv("REFRESH_TOKEN", "invalid_token")
+    with pytest.raises(ValidationError) as excinfo:
+        Settings()
+    assert "REFRESH_TOKEN should be a GitHub OAuth token starting with 'gho_'" in str(
+        excinfo.value
+    )
+
+    # Valid token
+    monkeypatch.setenv("REFRESH_TOKEN", "gho_valid_token")
+    settings = Settings()
+    assert settings.refresh_token == "gho_valid_token"
+
+
+def test_default_values():
+    """Test that default values are set correctly."""
+    # Only the declared defaults are checked, so skip validation and the environment
+    default_settings = Settings.model_construct(
+        refresh_token="gho_valid_token", rate_limits={}
+    )
+    assert (
+        default_settings.chat_completions_api_endpoint
+        == "https://api.individual.githubcopilot.com/chat/completions"
+    )
+    assert (
+        default_settings.models_api_endpoint
+        == "https://api.individual.githubcopilot.com/models"
+    )
+    assert default_settings.editor_version == "vscode/1.97.2"
+    assert default_settings.max_tokens == 10240
+    assert default_settings.timeout_seconds == 300
+    assert default_settings.record_traffic is False
+
+
+def test_custom_values(custom_settings: Settings):
+    """Test that custom values can be set."""
+    assert (
+        custom_settings.chat_completions_api_endpoint == "https://custom.endpoint/chat"
+    )
+    assert custom_settings.models_api_endpoint == "https://custom.endpoint/models"
+    assert custom_settings.editor_version == "custom-editor/1.0"
+    assert custom_settings.max_tokens == 5000
+    assert custom_settings.timeout_seconds == 600
+    assert custom_settings.record_traffic is True
+
+
+@pytest.mark.parametrize(
+    "value, expected",
+    [
+        ("true", True),
+        ("True", True),
+        ("TRUE", True),
+        ("1", True),
+        ("yes", True),
+        ("false", False),
+        ("False", False),
+        ("FALSE", False),
+        ("0", False),
+        ("no", False),
+    ],
+)
+def test_boolean_conversion(monkeypatch, value: str, expected: bool):
+    """Test that boolean values are converted correctly."""
+    monkeypatch.setenv("REFRESH_TOKEN", "gho_valid_token")
+    monkeypatch.setenv("RECORD_TRAFFIC", value)
+    assert Settings().record_traffic is expected
+
+
+@pytest.mark.parametrize(
+    "contents, expected",
+    [
+        (
+            VALID_LIMITS_JSON,
+            {
+                "test-model": (
+                    RateLimitSettings(
+                        window_minutes=1,
+                        total_tokens=1000,
+                        input_tokens=500,
+                        output_tokens=500,
+                        requests=5,
+                        behavior=RateLimitBehavior.DELAY,
+                    ),
+                )
+            },
+        ),
+        (None, {}),
+        ("invalid json", {}),
+        (INVALID_LIMITS_JSON, {}),
+    ],
+    ids=["valid", "file_not_found", "invalid_json", "invalid_schema"],
+)
+def test_rate_limits_loading(
+    rate_limits_file: Path, contents: Optional[str], expected: dict
+):
+    """Test loading rate limits, which are empty if the file is missing or invalid."""
+    if contents is not None:
+        rate_limits_file.write_text(contents)
+    assert Settings().rate_limits == expected
+
+
+def test_rate_limits_interpolate_env_vars(rate_limits_file: Path, monkeypatch):
+    """Test that ${VAR} references in the rate limits file are substituted."""
+    monkeypatch.setenv("TEST_TOKEN_LIMIT", "1000")
+    rate_limits_file.write_text(
+        '{"test-model": [{"window_minutes": 1, "total_tokens": ${TEST_TOKEN_LIMIT}}]}'
+    )
+    assert Settings().rate_limits["test-model"][0].total_tokens == 1000
+
+
+def test_rate_limits_undefined_env_var_is_reported(
+    rate_limits_file: Path, monkeypatch, capsys
+):
+    """Test that an undefined ${VAR} disables rate limits with an error naming it."""
+    monkeypatch.delenv("UNDEFINED_TOKEN_LIMIT", raising=False)
+    rate_limits_file.write_text(
+        '{"test-model": [{"window_minutes": 1, "total_tokens": ${UNDEFINED_TOKEN_LIMIT}}]}'
+    )
+    assert Settings().rate_limits == {}
+    assert "UNDEFINED_TOKEN_LIMIT" in capsys.readouterr().err
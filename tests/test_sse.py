@@ -0,0 +1,117 @@
+import asyncio
+from unittest.mock import Mock
+
+import pytest
+from aiohttp import StreamReader
+
+from copilot_more.sse import SSEParser, iter_batched
+
+
+@pytest.fixture
+def parser() -> SSEParser:
+    """Create a fresh SSEParser instance for each test"""
+    return SSEParser()
+
+
+def test_feed_complete_events(parser: SSEParser) -> None:
+    events = list(parser.feed(b'data: {"a": 1}\n\ndata: {"b": 2}\n\n'))
+    assert events == [{"a": 1}, {"b": 2}]
+    assert not parser.buffer
+
+
+def test_feed_event_split_across_chunks(parser: SSEParser) -> None:
+    assert list(parser.feed(b'data: {"a"')) == []
+    assert list(parser.feed(b": 1}\n")) == []
+    assert list(parser.feed(b'\ndata: {"b": 2}')) == [{"a": 1}]
+    assert list(parser.feed(b"\n\n")) == [{"b": 2}]
+
+
+def test_feed_skips_done_and_non_data_events(parser: SSEParser) -> None:
+    events = list(
+        parser.feed(
+            b': keep-alive\n\nevent: ping\n\ndata: {"a": 1}\n\ndata: [DONE]\n\n'
+        )
+    )
+    assert events == [{"a": 1}]
+
+
+def test_feed_skips_invalid_json(parser: SSEParser) -> None:
+    events = list(parser.feed(b'data: {not json}\n\ndata: {"a": 1}\n\n'))
+    assert events == [{"a": 1}]
+
+
+def test_feed_multibyte_character_split_across_chunks(parser: SSEParser) -> None:
+    data = 'data: {"text": "héllo"}\n\n'.encode("utf-8")
+    split = data.index("é".encode("utf-8")) + 1
+    assert list(parser.feed(data[:split])) == []
+    assert list(parser.feed(data[split:])) == [{"text": "héllo"}]
+
+
+def test_feed_separator_split_across_chunks(parser: SSEParser) -> None:
+    assert list(parser.feed(b'data: {"a": 1}\n')) == []
+    assert list(parser.feed(b'\ndata: {"b"')) == [{"a": 1}]
+    assert list(parser.feed(b": 2}\n")) == []
+    assert list(parser.feed(b"\n")) == [{"b": 2}]
+
+
+def stream_reader() -> StreamReader:
+    return StreamReader(
+        Mock(_reading_paused=False), 2**16, loop=asyncio.get_running_loop()
+    )
+
+
+async def wait_for_batches(batches: list, count: int) -> None:
+    """Wait until count batches have been yielded, failing after a generous timeout"""
+
+    async def poll():
+        while len(batches) < count:
+            await asyncio.sleep(0.001)
+
+    await asyncio.wait_for(poll(), timeout=5)
+
+
+@pytest.mark.asyncio
+async def test_iter_batched_flushes_on_size_and_eof() -> None:
+    content = stream_reader()
+    batches = []
+
+    async def consume():
+        # A delay long enough that only size and EOF can flush
+        async for batch in iter_batched(content, max_bytes=8, max_delay=60):
+            batches.append(batch)
+
+    consumer = asyncio.create_task(consume())
+    content.feed_data(b"abc")
+    content.feed_data(b"de")
+    for _ in range(5):
+        await asyncio.sleep(0)
+    assert batches == []  # Held back below the size limit
+
+    content.feed_data(b"0123456789")
+    await wait_for_batches(batches, 1)
+    assert batches == [b"abcde0123456789"]  # Size reached, sent at once
+
+    content.feed_data(b"xy")
+    content.feed_eof()
+    await asyncio.wait_for(consumer, timeout=5)
+    assert batches == [b"abcde0123456789", b"xy"]
+
+
+@pytest.mark.asyncio
+async def test_iter_batched_flushes_after_delay() -> None:
+    content = stream_reader()
+    batches = []
+
+    async def consume():
+        async for batch in iter_batched(content, max_bytes=1024, max_delay=0.01):
+            batches.append(batch)
+
+    consumer = asyncio.create_task(consume())
+    content.feed_data(b"abc")
+    # Sent once the delay passes, though the stream stays open
+    await wait_for_batches(batches, 1)
+    assert batches == [b"abc"]
+
+    content.feed_eof()
+    await asyncio.wait_for(consumer, timeout=5)
+    assert batches == [b"abc"]
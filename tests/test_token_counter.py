@@ -0,0 +1,166 @@
+import os
+from datetime import datetime, timedelta
+
+import pyarrow as pa  # type: ignore
+import pyarrow.parquet as pq  # type: ignore
+import pytest
+
+from copilot_more.token_counter import PYSTORE_PATH, TokenUsage, UsageWindow
+
+
+@pytest.fixture
+def base_time():
+    return datetime(2025, 1, 1, 12, 0, 0)  # Noon on Jan 1st, 2025
+
+
+@pytest.fixture
+def token_usage(tmp_path, monkeypatch) -> TokenUsage:
+    """A tracker storing usage in a temporary directory"""
+    monkeypatch.chdir(tmp_path)
+    return TokenUsage()
+
+
+@pytest.fixture
+def window(base_time) -> UsageWindow:
+    """A window with one record per minute for five minutes"""
+    window = UsageWindow()
+    for minute in range(5):
+        window.add(base_time + timedelta(minutes=minute), 10 * (minute + 1), 1)
+    return window
+
+
+def test_totals_for_range(window: UsageWindow, base_time) -> None:
+    # Records at minutes 1, 2 and 3; both ends are inclusive
+    totals = window.totals(
+        base_time + timedelta(minutes=1), base_time + timedelta(minutes=3)
+    )
+    assert totals == (20 + 30 + 40, 3, 20 + 30 + 40 + 3, 3)
+
+
+def test_totals_outside_records(window: UsageWindow, base_time) -> None:
+    assert window.totals(
+        base_time - timedelta(hours=1), base_time - timedelta(minutes=1)
+    ) == (
+        0,
+        0,
+        0,
+        0,
+    )
+    assert window.totals(base_time, base_time + timedelta(hours=1)) == (150, 5, 155, 5)
+
+
+def test_totals_after_eviction(window: UsageWindow, base_time) -> None:
+    window.evict_before(base_time + timedelta(minutes=2))
+    assert len(window.timestamps) == 3
+
+    # Evicted records no longer count, retained ones are unaffected
+    assert window.totals(base_time, base_time + timedelta(hours=1)) == (120, 3, 123, 3)
+    assert window.totals(
+        base_time + timedelta(minutes=4), base_time + timedelta(minutes=4)
+    ) == (
+        50,
+        1,
+        51,
+        1,
+    )
+
+    window.add(base_time + timedelta(minutes=5), 60, 1)
+    assert window.totals(base_time, base_time + timedelta(hours=1)) == (180, 4, 184, 4)
+
+
+def test_totals_with_out_of_order_record(window: UsageWindow, base_time) -> None:
+    # A record older than the newest one, e.g. after the clock stepped back
+    window.add(base_time + timedelta(minutes=1, seconds=30), 100, 1)
+    assert window.timestamps == sorted(window.timestamps)
+
+    assert window.totals(base_time, base_time + timedelta(hours=1)) == (250, 6, 256, 6)
+    assert window.totals(
+        base_time + timedelta(minutes=1), base_time + timedelta(minutes=2)
+    ) == (
+        20 + 100 + 30,
+        3,
+        20 + 100 + 30 + 3,
+        3,
+    )
+    assert window.totals(
+        base_time + timedelta(minutes=3), base_time + timedelta(minutes=4)
+    ) == (
+        90,
+        2,
+        92,
+        2,
+    )
+
+    window.evict_before(base_time + timedelta(minutes=2))
+    assert window.totals(base_time, base_time + timedelta(hours=1)) == (120, 3, 123, 3)
+
+
+def test_record_and_query_usage(token_usage: TokenUsage) -> None:
+    now = datetime.now()
+    token_usage.record_usage("gpt-4o", 100, 10, now - timedelta(hours=2))
+    token_usage.record_usage("gpt-4o", 200, 20, now - timedelta(minutes=5))
+    token_usage.record_usage("o1", 300, 30, now - timedelta(minutes=1))
+
+    # Recent windows are answered from memory, older ones from the store
+    for start in (now - timedelta(hours=3), now - timedelta(days=3)):
+        assert token_usage.query_usage_multi(
+            [start, now - timedelta(hours=1)], now, "gpt-4o"
+        ) == [
+            {
+                "total_input_tokens": 300,
+                "total_output_tokens": 30,
+                "total_tokens": 330,
+                "record_count": 2,
+                "model": "gpt-4o",
+            },
+            {
+                "total_input_tokens": 200,
+                "total_output_tokens": 20,
+                "total_tokens": 220,
+                "record_count": 1,
+                "model": "gpt-4o",
+            },
+        ]
+    assert token_usage.query_usage(now - timedelta(days=3), now)["total_tokens"] == 660
+
+    assert sorted(token_usage.get_available_models()) == ["gpt-4o", "o1"]
+    # A new tracker reads back what was recorded
+    assert TokenUsage().query_usage(now - timedelta(days=3), now)["total_tokens"] == 660
+
+
+@pytest.mark.asyncio
+async def test_flusher_writes_pending_usage(token_usage: TokenUsage) -> None:
+    token_usage.start_flusher()
+    now = datetime.now()
+    token_usage.record_usage("gpt-4o", 100, 10, now)
+    assert not os.path.isdir(token_usage.path)  # Queued, not yet written
+
+    await token_usage.close()
+    assert TokenUsage().query_usage(now - timedelta(days=3), now)["total_tokens"] == 110
+
+
+def test_migrates_legacy_pystore_usage(tmp_path, monkeypatch) -> None:
+    monkeypatch.chdir(tmp_path)
+    legacy_item = os.path.join(PYSTORE_PATH, "token_metrics", "usage", "token_usage")
+    os.makedirs(legacy_item)
+    # Laid out as PyStore wrote it: Dask parquet parts indexed by timestamp
+    timestamp = datetime(2025, 1, 1, 12, 0, 0)
+    pq.write_table(
+        pa.table(
+            {
+                "record_id": ["a"],
+                "model": ["gpt-4o"],
+                "input_tokens": [100],
+                "output_tokens": [10],
+                "total_tokens": [110],
+                "__null_dask_index__": pa.array([timestamp], pa.timestamp("ns")),
+            }
+        ).replace_schema_metadata(
+            {b"pandas": b'{"index_columns": ["__null_dask_index__"]}'}
+        ),
+        os.path.join(legacy_item, "part.0.parquet"),
+    )
+
+    token_usage = TokenUsage()
+    assert token_usage.get_available_models() == ["gpt-4o"]
+    assert token_usage.query_usage(timestamp, timestamp)["total_tokens"] == 110